@@ -1,6 +1,11 @@
 from __future__ import print_function
 from lib.utils import argmin_random_tie, count, first
-from lib.constraint_propagation import AC3
+from lib.constraint_propagation import AC3, AC3_queue, AC3rm, AC4, AC3_vectorized, SAC1, PC2
+from lib.domains import popcount
+from lib.global_constraints import propagate_constraints, forward_check_constraints
+
+from collections import OrderedDict, defaultdict
+import random
 
 #--------------------------------------------------------------------------------------------#
 # INFERENCE
@@ -15,6 +20,9 @@ def forward_checking(csp, var, assignment, removals):
     csp.support_pruning()
     # Get val.
     val = assignment[var]
+    if csp.relations is not None:
+        return (forward_checking_compiled(csp, var, val, assignment, removals) and
+                (not csp.var_checks or forward_check_constraints(csp, var, assignment, removals)))
     # Loop over domains of yet not assigned variables neighbors of var.
     for B in csp.neighbors[var]:
         if B not in assignment:
@@ -26,9 +34,36 @@ def forward_checking(csp, var, assignment, removals):
                     # We got an empty domain!
                     if len(csp.curr_domains[B]) == 0:
                         # var = val is not arc-consistent!
+                        if csp.arc_weights is not None:
+                            csp.weigh_arc(var, B)
+                        return False
+    # And the n-ary constraints on var.
+    return not csp.var_checks or forward_check_constraints(csp, var, assignment, removals)
+
+def forward_checking_compiled(csp, var, val, assignment, removals):
+    """ Forward checking with the tables of csp.compile_constraints():
+    B = b is consistent with var = val iff b's bit is set in the table row of val. """
+    index = csp.value_index
+    j = index[val]
+    for B in csp.neighbors[var]:
+        if B not in assignment:
+            row = csp.relations[var, B][j]
+            for b in csp.curr_domains[B][:]:
+                if not row >> index[b] & 1:
+                    csp.prune(B, b, removals)
+                    if len(csp.curr_domains[B]) == 0:
+                        if csp.arc_weights is not None:
+                            csp.weigh_arc(var, B)
                         return False
     return True
 
+def undo_inference(csp, mark, removals):
+    """ Undoes a supposition and its inferences, by trail checkpoint or removals list """
+    if mark is None:
+        csp.restore(removals)
+    else:
+        csp.rollback_to(mark)
+
 def restore_domains(csp, var):
     """ Restores the domains that a variable var pruned when doing inference """
     for (B, b) in csp.pruned[var]:
@@ -36,9 +71,69 @@ def restore_domains(csp, var):
     csp.pruned[var] = []
     
 def mac(csp, var, assignment, removals):
-    """Maintain arc consistency."""
+    """Maintain arc consistency; on the n-ary constraints too, if any."""
+    if csp.var_checks:
+        return mac_nary(csp, [var], removals)
     return AC3(csp, [(X, var) for X in csp.neighbors[var]], removals)
 
+def mac_nary(csp, changed, removals):
+    """ Alternate AC3 on the binary constraints and propagate_constraints on the
+    checked n-ary ones, from the variables whose domains changed, until neither
+    prunes anything. """
+    domains = csp.curr_domains
+    while changed:
+        sizes = {X: len(domains[X]) for X in csp.variables}
+        if not (AC3(csp, [(X, Y) for Y in changed for X in csp.neighbors[Y]], removals) and
+                propagate_constraints(csp, changed, removals, index=csp.var_checks)):
+            return False
+        changed = [X for X in csp.variables if len(domains[X]) != sizes[X]]
+    return True
+
+def mac_queue(csp, var, assignment, removals):
+    """Maintain arc consistency with AC3_queue (duplicate-free FIFO arc queue)."""
+    return AC3_queue(csp, [(X, var) for X in csp.neighbors[var]], removals)
+
+def gac(csp, var, assignment, removals):
+    """Generalized arc consistency on the n-ary constraints of the csp
+    (csp.nary_constraints), e.g. matching-based AllDifferent. Binary
+    constraints are not propagated: use it when the n-ary ones cover them."""
+    return propagate_constraints(csp, [var], removals)
+
+def gac_bounds(csp, var, assignment, removals):
+    """gac with bounds consistency only for AllDifferent."""
+    return propagate_constraints(csp, [var], removals, bounds=True)
+
+def singleton_consistency(max_depth=1):
+    """Return an inference function that enforces SAC1 while at most
+    max_depth variables are assigned, and does mac below that depth."""
+    def sac(csp, var, assignment, removals):
+        if len(assignment) > max_depth:
+            return mac(csp, var, assignment, removals)
+        return SAC1(csp, removals)
+    return sac
+
+def path_consistency(max_depth=1):
+    """Return an inference function that enforces PC2 (pruning the domains,
+    not keeping the tighter relations) while at most max_depth variables
+    are assigned, and does mac below that depth."""
+    def pc(csp, var, assignment, removals):
+        if len(assignment) > max_depth:
+            return mac(csp, var, assignment, removals)
+        return PC2(csp, removals)
+    return pc
+
+def mac_rm(csp, var, assignment, removals):
+    """Maintain arc consistency with AC3rm (residual supports)."""
+    return AC3rm(csp, [(X, var) for X in csp.neighbors[var]], removals)
+
+def mac_ac4(csp, var, assignment, removals):
+    """Maintain arc consistency with AC4, reusing its support counters."""
+    return AC4(csp, removals=removals)
+
+def mac_vectorized(csp, var, assignment, removals):
+    """Maintain arc consistency with AC3_vectorized."""
+    return AC3_vectorized(csp, [(X, var) for X in csp.neighbors[var]], removals)
+
 #--------------------------------------------------------------------------------------------#
 # SELECT_UNASSIGNED_VARIABLE
 def first_unassigned_variable(assignment, csp):
@@ -52,6 +147,52 @@ def mrv(assignment, csp):
         [var for var in csp.variables if var not in assignment],
         key=lambda var: num_legal_values(csp, var, assignment))
 
+def mrv_indexed(assignment, csp):
+    """Minimum-remaining-values heuristic read from csp.mrv_index, which is kept
+    up to date as domains change: O(1) amortised per decision instead of a scan.
+    Ties are broken at random. The index is built on the first call with a new
+    assignment, so the search must change the assignment only by csp.assign and
+    csp.unassign."""
+    if csp.mrv_index is None or csp.indexed is not assignment:
+        csp.support_mrv_index(assignment)
+    return csp.mrv_index.smallest()
+
+def mrv_weighted(assignment, csp):
+    """Minimum-remaining-values heuristic, breaking ties in favour of the variables
+    with the most dead ends so far (csp.var_weights, kept across restarts)."""
+    weights = csp.var_weights or {}
+    return argmin_random_tie(
+        [var for var in csp.variables if var not in assignment],
+        key=lambda var: (num_legal_values(csp, var, assignment), -weights.get(var, 0)))
+
+def dom_wdeg(assignment, csp):
+    """Domain over weighted degree heuristic (Boussemart et al., 2004): pick the
+    variable with the smallest ratio of domain size to the summed weights of its
+    constraints with unassigned variables. Weights start at 1 and are bumped by
+    revise and forward_checking each time a constraint wipes out a domain, so the
+    search turns to the variables of the hard part of the problem. Ties are broken
+    at random in the same pass."""
+    csp.support_arc_weights()
+    weights, var_arcs, index, variables = (csp.arc_weights, csp.var_arcs,
+                                           csp.var_index, csp.variables)
+    best, best_score, ties = None, None, 0
+    for var in variables:
+        if var in assignment:
+            continue
+        wdeg = 0
+        for j, k in var_arcs[index[var]]:
+            if variables[j] not in assignment:
+                wdeg += weights[k]
+        # A variable with no unassigned neighbors constrains nothing: leave it last.
+        score = num_legal_values(csp, var, assignment) / wdeg if wdeg else float('inf')
+        if best is None or score < best_score:
+            best, best_score, ties = var, score, 1
+        elif score == best_score:
+            ties += 1
+            if random.random() * ties < 1:
+                best = var
+    return best
+
 def num_legal_values(csp, var, assignment):
     if csp.curr_domains:
         return len(csp.curr_domains[var])
@@ -71,6 +212,32 @@ def lcv(var, assignment, csp):
     return sorted(csp.choices(var),
                   key=lambda val: csp.nconflicts(var, val, assignment))
 
+def lcv_supports(var, assignment, csp):
+    """Least-constraining-values heuristic that ranks each value by the number of
+    values it would remove from the current domains of the unassigned neighbors.
+    With compiled constraints that is a popcount of the domain of each neighbor
+    minus the row of the value in their table; otherwise the constraints are
+    called once per pair of values."""
+    csp.support_pruning()
+    values = csp.choices(var)
+    removed = dict.fromkeys(values, 0)
+    if csp.relations is not None:
+        index = csp.value_index
+        for B in csp.neighbors[var]:
+            if B not in assignment:
+                rows = csp.relations[var, B]
+                dB = csp.domain_mask(B)
+                size = popcount(dB)
+                for val in values:
+                    removed[val] += size - popcount(rows[index[val]] & dB)
+    else:
+        for B in csp.neighbors[var]:
+            if B not in assignment:
+                domain = csp.curr_domains[B]
+                for val in values:
+                    removed[val] += count(not csp.constraints(var, val, B, b) for b in domain)
+    return sorted(values, key=removed.__getitem__)
+
 
 #--------------------------------------------------------------------------------------------#
 #--------------------------------------------------------------------------------------------#
@@ -96,6 +263,8 @@ def backtracking_search(csp, select_unassigned_variable = first_unassigned_varia
                 csp.assign(var, val, assignment)
                 # If we do not use forward checking, we are good!
                 # If we do forward checking, prune domains, and continue only if no domain is empty.
+                # With a trail domain store, a checkpoint replaces the removals list.
+                mark = csp.checkpoint()
                 removals = csp.suppose(var, val)
                 infer = inference(csp, var, assignment, removals)
                 csp.track_pruned_domain_for_display()
@@ -104,7 +273,7 @@ def backtracking_search(csp, select_unassigned_variable = first_unassigned_varia
                     result = backtrack(assignment, csp)
                     if result is not None:
                         return result
-                csp.restore(removals)
+                undo_inference(csp, mark, removals)
                 # If we have a conflict, unassign.
                 # If we use forward checking, restore domains pruned by this assignment var=val.
                 csp.unassign(var, assignment) # could be done outside the for loop...
@@ -115,3 +284,268 @@ def backtracking_search(csp, select_unassigned_variable = first_unassigned_varia
     assert result is None or csp.goal_test(result)
     return result
 
+
+# ______________________________________________________________________________
+# Iterative Backtracking Algorithm
+def iterative_backtracking_search(csp, select_unassigned_variable = first_unassigned_variable,
+                                  order_domain_values = unordered_domain_values,
+                                  inference = no_inference):
+    """ Same search as backtracking_search, with the same plug-ins and results, but
+    with an explicit stack of decisions instead of one recursive call per variable,
+    so it is not limited by sys.getrecursionlimit(). """
+    result = next(backtracking_solutions(csp, select_unassigned_variable, order_domain_values,
+                                         inference, copy=False), None)
+    assert result is None or csp.goal_test(result)
+    return result
+
+def backtracking_solutions(csp, select_unassigned_variable = first_unassigned_variable,
+                           order_domain_values = unordered_domain_values,
+                           inference = no_inference, limit = None, copy = True,
+                           assignment = None, max_nodes = None):
+    """ Generate the solutions of the csp one at a time, stopping after limit of them
+    if given (e.g. limit=2 to check that a Sudoku has a unique solution).
+    The search keeps an explicit stack of decisions, so it is not limited by
+    sys.getrecursionlimit(). Each solution is a new dict; with copy=False the search's
+    own assignment is yielded instead, which is only valid until the next one.
+    The search can start from a partial assignment, whose inferences must already
+    be applied to the csp. If max_nodes is given, the search stops after that many
+    assignments, undoes its decisions, and the generator returns (as
+    StopIteration.value) the part of the tree it did not explore, as a list of
+    decision prefixes [(var, val), ...]. If csp.var_weights is a dict, the dead
+    ends met at each variable are counted in it. """
+    if assignment is None:
+        assignment = {}
+    # One frame per decision: [var, remaining values, checkpoint mark, removals].
+    stack = []
+    found = 0
+    nodes = 0
+    while True:
+        if max_nodes is not None and nodes >= max_nodes and len(assignment) < len(csp.variables):
+            # Out of budget: hand back the subtrees hanging off the current path,
+            # and leave the csp as we found it.
+            path = [(frame[0], assignment[frame[0]]) for frame in stack]
+            frontier = [path[:i] + [(frame[0], val)]
+                        for i, frame in enumerate(stack) for val in frame[1]]
+            frontier.append(path)
+            for frame in reversed(stack):
+                undo_inference(csp, frame[2], frame[3])
+                csp.unassign(frame[0], assignment)
+            return frontier
+        if len(assignment) == len(csp.variables):
+            # Complete assignment: report it, then backtrack to look for the next one.
+            yield dict(assignment) if copy else assignment
+            found += 1
+            if found == limit:
+                return
+        else:
+            # Open a new decision on an unassigned variable.
+            var = select_unassigned_variable(assignment, csp)
+            stack.append([var, iter(order_domain_values(var, assignment, csp)), None, None])
+        # Find the next consistent value of the decision on top of the stack,
+        # popping (backtracking over) the decisions that run out of values.
+        while stack:
+            frame = stack[-1]
+            var, values = frame[0], frame[1]
+            if var in assignment:
+                # We come back to a decision whose value has been explored: undo it.
+                undo_inference(csp, frame[2], frame[3])
+                csp.unassign(var, assignment)
+            for val in values:
+                if csp.is_consistent(var, val, assignment):
+                    csp.assign(var, val, assignment)
+                    nodes += 1
+                    mark = csp.checkpoint()
+                    removals = csp.suppose(var, val)
+                    infer = inference(csp, var, assignment, removals)
+                    csp.track_pruned_domain_for_display()
+                    if infer:
+                        frame[2], frame[3] = mark, removals
+                        break
+                    undo_inference(csp, mark, removals)
+                    csp.unassign(var, assignment)
+            else:
+                # Dead end: every value of var failed.
+                if csp.var_weights is not None:
+                    csp.var_weights[var] = csp.var_weights.get(var, 0) + 1
+                stack.pop()
+                continue
+            break
+        if not stack:
+            return
+
+def count_solutions(csp, select_unassigned_variable = first_unassigned_variable,
+                    order_domain_values = unordered_domain_values,
+                    inference = no_inference, limit = None):
+    """ Count the solutions of the csp (up to limit), without building a dict for each. """
+    return sum(1 for _ in backtracking_solutions(csp, select_unassigned_variable,
+                                                 order_domain_values, inference,
+                                                 limit=limit, copy=False))
+
+# ______________________________________________________________________________
+# Randomized restarts
+def luby(i):
+    """ The i-th term (i >= 1) of the Luby sequence 1, 1, 2, 1, 1, 2, 4, 1, 1, 2, ... """
+    k = 1
+    while (1 << k) - 1 < i:
+        k += 1
+    if i == (1 << k) - 1:
+        return 1 << (k - 1)
+    return luby(i - (1 << (k - 1)) + 1)
+
+def restart_search(csp, select_unassigned_variable = mrv_weighted,
+                   order_domain_values = unordered_domain_values,
+                   inference = no_inference, schedule = 'luby', base = 100, factor = 1.5,
+                   max_restarts = None):
+    """ Backtracking search restarted from scratch whenever a run uses up its budget of
+    assignments, to cut the heavy tail of randomized heuristics such as mrv.
+    The budget of run i is base * luby(i) with schedule='luby', or base * factor**i
+    with schedule='geometric'. Learned information is kept from one run to the next:
+    the dead ends per variable in csp.var_weights (used by mrv_weighted), and anything
+    else the plug-ins store on the csp. Returns the solution, or None if the csp has
+    none (or max_restarts runs were not enough); csp.restarts counts the restarts. """
+    if csp.var_weights is None:
+        csp.var_weights = {}
+    csp.restarts = 0
+    while True:
+        if schedule == 'luby':
+            budget = base * luby(csp.restarts + 1)
+        elif schedule == 'geometric':
+            budget = int(base * factor ** csp.restarts)
+        else:
+            raise ValueError("schedule must be either 'luby' or 'geometric'.")
+        solutions = backtracking_solutions(csp, select_unassigned_variable, order_domain_values,
+                                           inference, copy=False, max_nodes=budget)
+        try:
+            return next(solutions)
+        except StopIteration as stop:
+            if not stop.value:
+                return None  # The whole tree was explored: no solution.
+        if max_restarts is not None and csp.restarts >= max_restarts:
+            return None
+        csp.restarts += 1
+
+# ______________________________________________________________________________
+# Conflict-directed backjumping and nogood learning
+class NogoodStore:
+    """ A bounded store of nogoods: sets of (var, val) pairs that cannot all hold in a
+    solution. Nogoods are indexed by each of their pairs, and the least recently used
+    one is evicted when more than capacity are stored. """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.nogoods = OrderedDict()
+        self.index = defaultdict(set)
+
+    def add(self, nogood):
+        nogood = frozenset(nogood)
+        if nogood in self.nogoods:
+            self.nogoods.move_to_end(nogood)
+            return
+        self.nogoods[nogood] = None
+        for pair in nogood:
+            self.index[pair].add(nogood)
+        if len(self.nogoods) > self.capacity:
+            old, _ = self.nogoods.popitem(last=False)
+            for pair in old:
+                self.index[pair].discard(old)
+
+    def violated(self, var, val, assignment):
+        """ Return a nogood that var=val would complete given assignment, or None. """
+        for nogood in self.index.get((var, val), ()):
+            if all(X == var or assignment.get(X, nogood) == x for X, x in nogood):
+                self.nogoods.move_to_end(nogood)
+                return nogood
+        return None
+
+    def __len__(self):
+        return len(self.nogoods)
+
+def cbj_search(csp, select_unassigned_variable = first_unassigned_variable,
+               order_domain_values = unordered_domain_values,
+               inference = no_inference, nogoods = None):
+    """ Backtracking search with conflict-directed backjumping (Prosser, 1993).
+    Every variable keeps a conflict set: the earlier decisions that ruled out one of
+    its values. At a dead end the search jumps straight back to the latest variable in
+    the conflict set, instead of the previous one. If a NogoodStore is given, each dead
+    end also records its conflict set, with the current values, as a nogood, which
+    rules those values out when they meet again.
+    Explanations are exact with no_inference and forward_checking on binary csps;
+    with n-ary constraints or other inference functions (e.g. mac) a failed inference
+    is blamed on every decision, so the search backtracks chronologically there.
+    Statistics are left in csp.cbj_stats: assignments (nodes), backjumps, levels
+    skipped by them, nogoods stored, and nogood_prunes, values rejected by a nogood,
+    each of them a subtree the learning saved. """
+    exact = inference in (no_inference, forward_checking) and not csp.var_checks
+    stats = csp.cbj_stats = {'nodes': 0, 'backjumps': 0, 'levels_skipped': 0,
+                             'nogoods': 0, 'nogood_prunes': 0}
+    path = []
+    # The decisions that pruned values of each variable, for exact explanations.
+    pruned_by = defaultdict(set)
+
+    def culprits(var, val, assignment):
+        """ The assigned neighbors that conflict with var=val. """
+        found = {X for X in csp.neighbors[var]
+                 if X in assignment and X != var
+                 and not csp.constraints(var, val, X, assignment[X])}
+        return found or set(assignment)
+
+    def backtrack(assignment):
+        """ Return (solution, None), or (None, conflict set) when there is none below. """
+        if len(assignment) == len(csp.variables):
+            return assignment, None
+        var = select_unassigned_variable(assignment, csp)
+        conf = set(pruned_by[var]) if exact else set(assignment)
+        path.append(var)
+        for val in order_domain_values(var, assignment, csp):
+            if not csp.is_consistent(var, val, assignment):
+                conf |= culprits(var, val, assignment)
+                continue
+            if nogoods is not None:
+                nogood = nogoods.violated(var, val, assignment)
+                if nogood is not None:
+                    stats['nogood_prunes'] += 1
+                    conf |= {X for X, _ in nogood if X != var}
+                    continue
+            csp.assign(var, val, assignment)
+            stats['nodes'] += 1
+            mark = csp.checkpoint()
+            removals = csp.suppose(var, val)
+            pruned = removals if removals is not None else []
+            infer = inference(csp, var, assignment, pruned)
+            touched = {B for B, _ in pruned if B != var}
+            for B in touched:
+                pruned_by[B].add(var)
+            if infer:
+                result, child_conf = backtrack(assignment)
+                if result is not None:
+                    return result, None
+            elif exact:
+                # Blame the decisions that emptied the domain.
+                child_conf = set()
+                for B in touched:
+                    if not csp.curr_domains[B]:
+                        child_conf |= pruned_by[B]
+            else:
+                child_conf = set(assignment)
+            for B in touched:
+                pruned_by[B].discard(var)
+            undo_inference(csp, mark, removals)
+            csp.unassign(var, assignment)
+            if var not in child_conf:
+                # The failure below does not depend on var: jump over it.
+                stats['levels_skipped'] += 1
+                path.pop()
+                return None, child_conf
+            conf |= child_conf - {var}
+        path.pop()
+        # Dead end: jump back to the latest decision in conf.
+        if len(path) > 0 and path[-1] not in conf:
+            stats['backjumps'] += 1
+        if nogoods is not None and conf:
+            nogoods.add((X, assignment[X]) for X in conf)
+            stats['nogoods'] = len(nogoods)
+        return None, conf
+
+    result, _ = backtrack({})
+    assert result is None or csp.goal_test(result)
+    return result
@@ -0,0 +1,247 @@
+"""Brute-force cross-checks for the stateful solvers of the library.
+
+Each check builds small random CSPs, runs an incremental algorithm on them
+and compares it with a plain one (exhaustive enumeration, or AC3 from
+scratch), so that bugs in the bookkeeping (AC-4 counters, Compact-Table
+trails, conflict sets and nogoods, MRV buckets, incremental conflict
+counts) show up without ad-hoc runs. Run them all with
+    python -m lib.checks
+or one at a time:
+    >>> check_ac4(seeds=5)
+    >>> check_compact_table(seeds=5)
+"""
+
+from lib.csp import CSP
+from lib.backtracking import (backtracking_solutions, cbj_search,
+                              NogoodStore, first_unassigned_variable, mrv, mrv_indexed,
+                              unordered_domain_values, no_inference, forward_checking,
+                              mac, mac_ac4, gac, singleton_consistency)
+from lib.constraint_propagation import AC3, AC3_queue, SAC1, propagate
+from lib.domains import BitsetDomains, TrailDomains
+from lib.global_constraints import (AllDifferent, CompactTable, Constraint, Sum, Table,
+                                     propagate_constraints)
+from lib.min_conflicts import min_conflicts
+
+import itertools
+import random
+
+STORES = (None, BitsetDomains, TrailDomains)
+
+
+def random_csp(seed, n=8, d=4, density=0.5, tightness=0.35, isolated=False):
+    """A random binary csp: each pair of variables is constrained with
+    probability density, and each constraint forbids a pair of values with
+    probability tightness. With isolated, variable 0 has no neighbors."""
+    rng = random.Random(seed)
+    variables = list(range(n))
+    neighbors = {var: [] for var in variables}
+    allowed = {}
+    for A, B in itertools.combinations(variables, 2):
+        if (isolated and A == 0) or rng.random() >= density:
+            continue
+        neighbors[A].append(B)
+        neighbors[B].append(A)
+        pairs = {(a, b) for a in range(d) for b in range(d) if rng.random() >= tightness}
+        allowed[A, B] = pairs
+        allowed[B, A] = {(b, a) for a, b in pairs}
+    return CSP(variables, {var: list(range(d)) for var in variables}, neighbors,
+               lambda A, a, B, b: (a, b) in allowed[A, B])
+
+
+def random_nary_csp(seed, n=6, d=4, table=Table):
+    """A random csp of n-ary constraints only: sums, tables (of the given
+    class), a predicate and an all-different."""
+    rng = random.Random(seed)
+    variables = list(range(n))
+    csp = CSP(variables, {var: list(range(d)) for var in variables},
+              {var: [] for var in variables}, None)
+    csp.add_constraint(Sum(variables[:4], 3, 2 * d))
+    for _ in range(2):
+        scope = rng.sample(variables, rng.choice([2, 3]))
+        csp.add_constraint(table(scope, [t for t in itertools.product(range(d), repeat=len(scope))
+                                         if rng.random() < 0.5]))
+    csp.add_constraint(Constraint(variables[3:], lambda a, b, c: (a + b * c) % 3 != 1))
+    csp.add_constraint(AllDifferent(variables[:3]))
+    return csp
+
+
+def count_by_enumeration(csp):
+    """The number of solutions, by trying every complete assignment."""
+    return sum(csp.goal_test(list(zip(csp.variables, values)))
+               for values in itertools.product(*(csp.domains[var] for var in csp.variables)))
+
+
+def count_solutions(csp, select=first_unassigned_variable, inference=no_inference):
+    return sum(1 for _ in backtracking_solutions(csp, select, unordered_domain_values, inference))
+
+
+def is_arc_consistent(csp):
+    return all(any(csp.constraints(X, x, Y, y) for y in csp.curr_domains[Y])
+               for X in csp.variables for Y in csp.neighbors[X] if Y != X
+               for x in csp.curr_domains[X])
+
+
+def check_ac4(seeds=100):
+    """After every successful mac_ac4 call of a search, the domains are arc
+    consistent, and the search finds as many solutions as mac."""
+    failures = []
+
+    def checked(csp, var, assignment, removals):
+        consistent = mac_ac4(csp, var, assignment, removals)
+        if consistent and not is_arc_consistent(csp):
+            failures.append(var)
+        return consistent
+
+    for seed in range(seeds):
+        for tightness in (0.3, 0.4):
+            csp = random_csp(seed, n=10, d=5, tightness=tightness)
+            AC3(csp)
+            found = sum(1 for _ in backtracking_solutions(csp, mrv, unordered_domain_values,
+                                                          checked, limit=50))
+            expected = count_solutions(random_csp(seed, n=10, d=5, tightness=tightness), mrv, mac)
+            assert found == min(expected, 50), (seed, found, expected)
+    assert not failures, '{} nodes not arc consistent'.format(len(failures))
+
+
+def check_propagation(seeds=50):
+    """AC3_queue (every policy), propagate and SAC1 (on every store) agree
+    with AC3, including on csps with an isolated variable."""
+    for seed in range(seeds):
+        reference = random_csp(seed, isolated=seed % 2)
+        consistent = AC3(reference)
+        runs = [lambda csp, policy=policy: AC3_queue(csp, policy=policy)
+                for policy in ('fifo', 'lifo', 'smallest', 'variable')]
+        runs.append(lambda csp: propagate(csp).status != 'failed')
+        for run in runs:
+            csp = random_csp(seed, isolated=seed % 2)
+            assert run(csp) == consistent, seed
+            if consistent:
+                assert all(set(csp.curr_domains[var]) == set(reference.curr_domains[var])
+                           for var in csp.variables), seed
+        for store in STORES:
+            csp = random_csp(seed, tightness=0.3)
+            csp.domain_store = store
+            SAC1(csp)
+
+
+def check_searches(seeds=40):
+    """Every inference, selection, store and cbj_search (with and without
+    nogoods) agree with enumeration on random binary csps."""
+    for seed in range(seeds):
+        expected = count_by_enumeration(random_csp(seed))
+        for store in STORES:
+            for select in (mrv, mrv_indexed):
+                for inference in (forward_checking, mac, mac_ac4, singleton_consistency(2)):
+                    csp = random_csp(seed)
+                    csp.domain_store = store
+                    assert count_solutions(csp, select, inference) == expected, \
+                        (seed, store, inference)
+        for inference in (no_inference, forward_checking, mac):
+            for nogoods in (None, NogoodStore(50)):
+                csp = random_csp(seed)
+                solution = cbj_search(csp, mrv, unordered_domain_values, inference, nogoods)
+                assert (solution is not None) == (expected > 0), seed
+                assert solution is None or csp.goal_test(solution.items()), seed
+
+
+def check_mrv_index(seeds=30):
+    """The MRV buckets hold the current domain size of every unassigned
+    variable, at every decision of a search."""
+    for seed in range(seeds):
+        for store in STORES:
+            csp = random_csp(seed, n=10, d=5)
+            csp.domain_store = store
+
+            def select(assignment, csp):
+                var = mrv_indexed(assignment, csp)
+                sizes = {X: len(csp.curr_domains[X])
+                         for X in csp.variables if X not in assignment}
+                assert csp.mrv_index.size == sizes, seed
+                assert sizes[var] == min(sizes.values()), seed
+                return var
+
+            count_solutions(csp, select, forward_checking)
+
+
+def check_nary(seeds=30):
+    """Searches over n-ary constraints (tables with STR and Compact-Table,
+    sums, predicates, all-different) agree with enumeration, for every
+    inference and store."""
+    for seed in range(seeds):
+        expected = count_by_enumeration(random_nary_csp(seed))
+        for table in (Table, CompactTable):
+            for store in STORES:
+                for inference in (no_inference, forward_checking, mac, gac):
+                    csp = random_nary_csp(seed, table=table)
+                    csp.domain_store = store
+                    assert count_solutions(csp, mrv, inference) == expected, \
+                        (seed, table, store, inference)
+
+
+def check_compact_table(seeds=30):
+    """Compact-Table prunes exactly as STR, at the root and at every node of
+    a search (which exercises its trail), on every store."""
+    for seed in range(seeds):
+        rng = random.Random(seed)
+        variables = list(range(6))
+        tables = []
+        for _ in range(4):
+            scope = rng.sample(variables, rng.choice([2, 3, 4]))
+            tables.append((scope, [t for t in itertools.product(range(4), repeat=len(scope))
+                                   if rng.random() < 0.45]))
+
+        def build(table, store=None):
+            csp = CSP(variables, {var: list(range(4)) for var in variables},
+                      {var: [] for var in variables}, None)
+            csp.domain_store = store
+            for scope, tuples in tables:
+                csp.add_constraint(table(scope, tuples))
+            return csp
+
+        expected = count_solutions(build(Table), mrv, gac)
+        for store in STORES:
+            assert count_solutions(build(CompactTable, store), mrv, gac) == expected, seed
+        a, b = build(Table), build(CompactTable)
+        consistent = propagate_constraints(a)
+        assert propagate_constraints(b) == consistent, seed
+        if consistent:
+            assert all(set(a.curr_domains[var]) == set(b.curr_domains[var])
+                       for var in variables), seed
+
+
+def check_conflict_counts(seeds=30):
+    """The incremental conflict counts match nconflicts computed from
+    scratch after random assignments, and min_conflicts only returns
+    solutions, with binary and n-ary constraints."""
+    for seed in range(seeds):
+        rng = random.Random(seed)
+        for compiled in (False, True):
+            csp = random_csp(seed)
+            if compiled:
+                csp.compile_constraints()
+            assignment = {}
+            csp.support_conflict_counts(assignment)
+            for _ in range(100):
+                var = rng.choice(csp.variables)
+                if rng.random() < 0.3:
+                    csp.unassign(var, assignment)
+                else:
+                    csp.assign(var, rng.randrange(4), assignment)
+                for X in csp.variables:
+                    for x in csp.domains[X]:
+                        counted = csp.nconflicts(X, x, assignment)
+                        csp.counted = None
+                        assert csp.nconflicts(X, x, assignment) == counted, seed
+                        csp.counted = assignment
+        for csp in (random_csp(seed, tightness=0.2), random_nary_csp(seed)):
+            solution = min_conflicts(csp, 500)
+            assert solution is None or csp.goal_test(solution.items()), seed
+
+
+CHECKS = (check_ac4, check_propagation, check_searches, check_mrv_index, check_nary,
+          check_compact_table, check_conflict_counts)
+
+if __name__ == '__main__':
+    for check in CHECKS:
+        check()
+        print(check.__name__, 'ok')
@@ -1,6 +1,10 @@
 # ______________________________________________________________________________
 # Constraint Propagation with AC-3
 import lib.csp
+from lib.domains import bits, popcount
+from collections import deque, namedtuple
+import heapq
+import numpy as np
 import time
 import matplotlib.pyplot as plt
 
@@ -21,14 +25,402 @@ def AC3(csp, queue=None, removals=None):
 
 def revise(csp, Xi, Xj, removals):
     """Return true if we remove a value."""
+    if csp.relations is not None:
+        revised = revise_compiled(csp, Xi, Xj, removals)
+    else:
+        revised = False
+        for x in csp.curr_domains[Xi][:]:
+            # If Xi=x conflicts with Xj=y for every possible y, eliminate Xi=x
+            if all(not csp.constraints(Xi, x, Xj, y) for y in csp.curr_domains[Xj]):
+                csp.prune(Xi, x, removals)
+                revised = True
+    if revised and csp.arc_weights is not None and not csp.curr_domains[Xi]:
+        csp.weigh_arc(Xi, Xj)
+    return revised
+
+def revise_compiled(csp, Xi, Xj, removals):
+    """revise using the tables of csp.compile_constraints(): Xi=x has a
+    support iff its row of the (Xi, Xj) table intersects the domain of Xj."""
     revised = False
+    rows = csp.relations[Xi, Xj]
+    index = csp.value_index
+    dj = csp.domain_mask(Xj)
     for x in csp.curr_domains[Xi][:]:
-        # If Xi=x conflicts with Xj=y for every possible y, eliminate Xi=x
-        if all(not csp.constraints(Xi, x, Xj, y) for y in csp.curr_domains[Xj]):
+        if not rows[index[x]] & dj:
             csp.prune(Xi, x, removals)
             revised = True
     return revised
 
+# ______________________________________________________________________________
+# Arc queues for AC-3
+
+class ArcQueue:
+    """The pending arcs of AC-3, each held at most once. policy is one of
+        'fifo'      Revise arcs in the order they were added
+        'lifo'      Revise the last arc added first (the order of AC3)
+        'smallest'  Revise first the arc (Xi, Xj) whose Xj had the smallest
+                    domain when it was added: few supports, likely prunes
+        'variable'  Queue the variables Xj instead of the arcs (McGregor,
+                    1979); popping Xj yields the arcs (Xk, Xj) one by one
+    Counts go to the stats dict: arcs pushed, duplicates (pushes dropped
+    because the arc was already pending, i.e. revisions saved), pops and
+    the longest the queue got."""
+
+    policies = ('fifo', 'lifo', 'smallest', 'variable')
+
+    def __init__(self, csp, policy='fifo', stats=None):
+        if policy not in self.policies:
+            raise ValueError('unknown arc queue policy: {}'.format(policy))
+        self.csp = csp
+        self.policy = policy
+        self.items = [] if policy in ('lifo', 'smallest') else deque()
+        self.pending = set()
+        self.arcs = deque()
+        self.ticket = 0
+        self.stats = stats if stats is not None else {}
+        for key in ('pushed', 'duplicates', 'popped', 'max_length'):
+            self.stats.setdefault(key, 0)
+
+    def push(self, arc):
+        """Add arc (Xi, Xj), unless it is already pending."""
+        key = arc[1] if self.policy == 'variable' else arc
+        if key in self.pending:
+            self.stats['duplicates'] += 1
+            return
+        self.pending.add(key)
+        self.stats['pushed'] += 1
+        if self.policy == 'smallest':
+            self.ticket += 1
+            heapq.heappush(self.items, (len(self.csp.curr_domains[arc[1]]), self.ticket, arc))
+        else:
+            self.items.append(key)
+        waiting = len(self.items) + len(self.arcs)
+        if waiting > self.stats['max_length']:
+            self.stats['max_length'] = waiting
+
+    def extend(self, arcs):
+        """Add every arc in arcs."""
+        for arc in arcs:
+            self.push(arc)
+
+    def pop(self):
+        """Remove and return the next arc to revise."""
+        self.stats['popped'] += 1
+        if self.policy == 'variable':
+            self.expand()
+            return self.arcs.popleft()
+        if self.policy == 'smallest':
+            arc = heapq.heappop(self.items)[2]
+        elif self.policy == 'fifo':
+            arc = self.items.popleft()
+        else:
+            arc = self.items.pop()
+        self.pending.discard(arc)
+        return arc
+
+    def expand(self):
+        """With the 'variable' policy, when no arc is left, dequeue variables
+        until one has neighbors, and queue its arcs."""
+        while not self.arcs and self.items:
+            Xj = self.items.popleft()
+            self.pending.discard(Xj)
+            self.arcs.extend((Xk, Xj) for Xk in self.csp.neighbors[Xj])
+
+    def __len__(self):
+        """Number of arcs (and variables) waiting. Variables without
+        neighbors are dropped first, so the queue is false once no arc can
+        be popped."""
+        if self.policy == 'variable':
+            self.expand()
+        return len(self.items) + len(self.arcs)
+
+def AC3_queue(csp, queue=None, removals=None, policy='fifo'):
+    """AC3 with an ArcQueue: an arc already waiting is not added again, and
+    arcs are revised in the order of policy. The queue statistics add up in
+    csp.arc_queue_stats (one dict for all calls, so mac_queue reports the
+    totals of a search), with the number of revisions and of revisions
+    that pruned something."""
+    if csp.arc_queue_stats is None:
+        csp.arc_queue_stats = {'revisions': 0, 'prunings': 0}
+    stats = csp.arc_queue_stats
+    pending = ArcQueue(csp, policy, stats)
+    if queue is None:
+        queue = ((Xi, Xk) for Xi in csp.variables for Xk in csp.neighbors[Xi])
+    csp.support_pruning()
+    pending.extend(queue)
+    while pending:
+        (Xi, Xj) = pending.pop()
+        stats['revisions'] += 1
+        if revise(csp, Xi, Xj, removals):
+            stats['prunings'] += 1
+            if not csp.curr_domains[Xi]:
+                return False
+            for Xk in csp.neighbors[Xi]:
+                if Xk != Xj:
+                    pending.push((Xk, Xi))
+    return True
+
+# ______________________________________________________________________________
+# AC-3rm: AC-3 with residual supports
+
+def AC3rm(csp, queue=None, removals=None):
+    """AC3 that remembers the last support found for every (Xi, x, Xj)
+    in csp.residues (Lecoutre & Hemery, 2007). A residue that is still in
+    the domain of Xj is a support, so revisiting an arc mostly costs one
+    bit test per value. Residues need no undoing when the search
+    backtracks, so this is a drop-in for AC3, and mac_rm for mac."""
+    if queue is None:
+        queue = [(Xi, Xk) for Xi in csp.variables for Xk in csp.neighbors[Xi]]
+    csp.support_pruning()
+    csp.intern()
+    if csp.residues is None:
+        csp.residues = {}
+    while queue:
+        (Xi, Xj) = queue.pop()
+        if revise_rm(csp, Xi, Xj, removals):
+            if not csp.curr_domains[Xi]:
+                return False
+            for Xk in csp.neighbors[Xi]:
+                if Xk != Xj:
+                    queue.append((Xk, Xi))
+    return True
+
+def revise_rm(csp, Xi, Xj, removals):
+    """revise, trying the residue of each value first. A new support
+    y found for x is also the residue of y on the arc (Xj, Xi)."""
+    residues = csp.residues
+    ij = residues.get((Xi, Xj))
+    if ij is None:
+        ij = residues[Xi, Xj] = {}
+        residues[Xj, Xi] = {}
+    ji = residues[Xj, Xi]
+    index = csp.value_index
+    dj = csp.domain_mask(Xj)
+    rows = csp.relations[Xi, Xj] if csp.relations is not None else None
+    revised = False
+    for x in csp.curr_domains[Xi][:]:
+        y = ij.get(x)
+        if y is not None and dj >> y & 1:
+            continue
+        if rows is not None:
+            support = rows[index[x]] & dj
+            y = (support & -support).bit_length() - 1 if support else None
+        else:
+            y = next((index[b] for b in csp.curr_domains[Xj]
+                      if csp.constraints(Xi, x, Xj, b)), None)
+        if y is None:
+            csp.prune(Xi, x, removals)
+            revised = True
+        else:
+            ij[x] = y
+            ji[csp.values[y]] = index[x]
+    if revised and csp.arc_weights is not None and not csp.curr_domains[Xi]:
+        csp.weigh_arc(Xi, Xj)
+    return revised
+
+# ______________________________________________________________________________
+# AC-4: support counters and support lists
+
+class AC4Supports:
+    """The support structures of AC-4 (Mohr & Henderson, 1986), over the
+    numbering of csp.intern():
+        counts[i, j][x]   Number of supports of value x of variable i in the
+                          domain of j, for every x of the initial domain
+        supported[j][y]   (i, x, counts[i, j]) for each value x of each
+                          neighbor i that value y of j supports
+        seen[j]           Bitmask of the values of j whose deletion the
+                          counts have not taken into account yet
+        deletions         Deletions propagated so far, and
+        decrements        support counts decremented by them
+    Built once in O(ed^2), then kept in step with the domains by AC4."""
+
+    def __init__(self, csp):
+        csp.intern()
+        relations, index = csp.relations, csp.value_index
+        n, d = len(csp.variables), len(csp.values)
+        self.counts = {}
+        self.supported = [[[] for _ in range(d)] for _ in range(n)]
+        self.seen = [0] * n
+        self.deletions = self.decrements = 0
+        for i, Xi in enumerate(csp.variables):
+            self.seen[i] = sum(1 << x for x in csp.domain_index[i])
+            for Xj in csp.neighbors[Xi]:
+                j = csp.var_index[Xj]
+                counts = self.counts[i, j] = [0] * d
+                rows = relations[Xi, Xj] if relations is not None else None
+                for a in csp.domains[Xi]:
+                    x = index[a]
+                    for b in csp.domains[Xj]:
+                        y = index[b]
+                        if (rows[x] >> y & 1 if rows is not None
+                                else csp.constraints(Xi, a, Xj, b)):
+                            counts[x] += 1
+                            self.supported[j][y].append((i, x, counts))
+        # Values with no support at all are checked on the first call.
+        self.unchecked = [(i, x) for i in range(n) for x in csp.domain_index[i]]
+
+def AC4(csp, queue=None, removals=None):
+    """AC-4: delete every value whose support count on some arc drops to
+    0, propagating deletions through a worklist in O(ed^2) overall.
+    The supports are built on the first call and kept in csp.ac4. Each
+    call first brings the counts in step with the current domains:
+    values restored by backtracking give their supports back, and values
+    pruned since the last call (by suppose, forward checking, ...) are
+    propagated. So queue is not needed, and mac_ac4 reuses the counts
+    across backtracking instead of rebuilding them."""
+    csp.support_pruning()
+    if csp.ac4 is None:
+        csp.ac4 = AC4Supports(csp)
+    ac4 = csp.ac4
+    variables, values = csp.variables, csp.values
+    seen, supported = ac4.seen, ac4.supported
+    now = [csp.domain_mask(var) for var in variables]
+    worklist, restored, pruned = [], [], []
+    for j in range(len(variables)):
+        if now[j] != seen[j]:
+            for y in bits(now[j] & ~seen[j]):
+                restored.append((j, y))
+                for i, x, counts in supported[j][y]:
+                    counts[x] += 1
+            seen[j] |= now[j]
+            worklist.extend((j, y) for y in bits(seen[j] & ~now[j]))
+    restored.extend(ac4.unchecked)
+    ac4.unchecked = []
+    # A restored value (or any value, on the first call) may lack support.
+    for k, (i, x) in enumerate(restored):
+        if now[i] >> x & 1:
+            for j in csp.neighbor_index[i]:
+                if not ac4.counts[i, j][x]:
+                    csp.prune(variables[i], values[x], removals)
+                    now[i] &= ~(1 << x)
+                    worklist.append((i, x))
+                    pruned.append((i, x))
+                    if not now[i]:
+                        # The rest are checked on the next call, and so are the
+                        # values pruned here, in case backtracking restores them.
+                        ac4.unchecked = restored[k + 1:] + pruned
+                        if csp.arc_weights is not None:
+                            csp.weigh_arc(variables[i], variables[j])
+                        return False
+                    break
+    while worklist:
+        j, y = worklist.pop()
+        seen[j] &= ~(1 << y)
+        ac4.deletions += 1
+        ac4.decrements += len(supported[j][y])
+        wiped = None
+        # Take all of y's supports away, even past a wipe-out, to keep the counts exact.
+        for i, x, counts in supported[j][y]:
+            counts[x] -= 1
+            if not counts[x] and wiped is None and now[i] >> x & 1:
+                csp.prune(variables[i], values[x], removals)
+                now[i] &= ~(1 << x)
+                worklist.append((i, x))
+                pruned.append((i, x))
+                if not now[i]:
+                    wiped = i
+        if wiped is not None:
+            # The deletions left on the worklist are not in the counts yet (their
+            # seen bits stay set), so restored values must have their supports
+            # checked again.
+            ac4.unchecked = pruned
+            if csp.arc_weights is not None:
+                csp.weigh_arc(variables[wiped], variables[j])
+            return False
+    return True
+
+# ______________________________________________________________________________
+# Vectorized AC-3 over boolean domain matrices
+
+class ArcMatrices:
+    """The arcs of a csp as NumPy arrays, over the numbering of csp.intern():
+    arc k goes from variable src[k] to dst[k] and its relation is the d x d
+    matrix tables[table[k]], whose entry [x, y] is 1 iff Xsrc=x is supported
+    by Xdst=y. Built once from the compiled constraints (compiling them if
+    needed, so give the csp a good compile_constraints key)."""
+
+    def __init__(self, csp):
+        if csp.relations is None:
+            csp.compile_constraints()
+        variables, d = csp.variables, len(csp.values)
+        numbers, tables, src, dst, table = {}, [], [], [], []
+        self.arc_id = {}
+        for i, A in enumerate(variables):
+            for B in csp.neighbors[A]:
+                rows = csp.relations[A, B]
+                if id(rows) not in numbers:
+                    numbers[id(rows)] = len(tables)
+                    tables.append([[row >> y & 1 for y in range(d)] for row in rows])
+                self.arc_id[A, B] = len(src)
+                src.append(i)
+                dst.append(csp.var_index[B])
+                table.append(numbers[id(rows)])
+        self.tables = np.array(tables, dtype=np.float32).reshape(-1, d, d)
+        self.src = np.array(src, dtype=np.intp)
+        self.dst = np.array(dst, dtype=np.intp)
+        self.table = np.array(table, dtype=np.intp)
+
+    def domains(self, csp):
+        """Return the current domains as a boolean n x d matrix."""
+        D = np.zeros((len(csp.variables), len(csp.values)), dtype=bool)
+        index = csp.value_index
+        for i, var in enumerate(csp.variables):
+            D[i, [index[val] for val in csp.curr_domains[var]]] = True
+        return D
+
+def AC3_vectorized(csp, queue=None, removals=None):
+    """AC3 on a boolean n x d domain matrix D. Every round revises a whole
+    batch of arcs at once: for the arcs of one relation T, the supports
+    of all their source values are D[dst] @ T.T, one matrix product. The
+    next batch is the arcs into the variables that lost values. Pruned
+    values are then removed through csp.prune, so this is a drop-in for
+    AC3 (and for mac, as mac_vectorized); on a wipe-out the domains are
+    left as they were."""
+    csp.support_pruning()
+    if csp.arc_matrices is None:
+        csp.arc_matrices = ArcMatrices(csp)
+    arcs = csp.arc_matrices
+    D = arcs.domains(csp)
+    D0 = D.copy()
+    if queue is None:
+        batch = np.arange(len(arcs.src))
+    else:
+        batch = np.array([arcs.arc_id[arc] for arc in queue], dtype=np.intp)
+    while len(batch):
+        # Revise the arcs of each relation with one matrix product.
+        batch = batch[np.argsort(arcs.table[batch], kind='stable')]
+        tables = arcs.table[batch]
+        cuts = np.flatnonzero(tables[1:] != tables[:-1]) + 1
+        Df = D.astype(np.float32)
+        supported = np.empty((len(batch), D.shape[1]), dtype=bool)
+        for lo, hi in zip(np.r_[0, cuts], np.r_[cuts, len(batch)]):
+            supported[lo:hi] = Df[arcs.dst[batch[lo:hi]]] @ arcs.tables[tables[lo]].T > 0
+        # A value is lost if any arc out of its variable leaves it unsupported.
+        src = arcs.src[batch]
+        order = np.argsort(src, kind='stable')
+        src = src[order]
+        heads = np.r_[0, np.flatnonzero(src[1:] != src[:-1]) + 1]
+        rows = src[heads]
+        unsupported = np.logical_or.reduceat(~supported[order], heads, axis=0) & D[rows]
+        lost = unsupported.any(axis=1)
+        if not lost.any():
+            break
+        rows, unsupported = rows[lost], unsupported[lost]
+        D[rows] &= ~unsupported
+        wiped = ~D[rows].any(axis=1)
+        if wiped.any():
+            if csp.arc_weights is not None:
+                i = rows[np.flatnonzero(wiped)[0]]
+                k = batch[order[np.searchsorted(src, i)]]
+                csp.weigh_arc(csp.variables[i], csp.variables[arcs.dst[k]])
+            return False
+        changed = np.zeros(len(D), dtype=bool)
+        changed[rows] = True
+        batch = np.flatnonzero(changed[arcs.dst])
+    for i, x in zip(*np.nonzero(D0 & ~D)):
+        csp.prune(csp.variables[i], csp.values[x], removals)
+    return True
+
 def AC1(csp, queue=None, removals=None):
     """[Figure 6.3]"""
     if queue is None:
@@ -39,69 +431,216 @@ def AC1(csp, queue=None, removals=None):
         revise(csp, Xi, Xj, removals); revise(csp, Xj, Xi, removals)
     return True
 
-def implementAC1(e,pr=True):
-    counter = 0
-    start_time = time.time()
-    elast = dict()
-    done = False
-    while True:
-        check =  False
-        AC1(e);
-        counter += 1
-        for i in range(80):
-            if i not in e.infer_assignment():
-                check = True
+# ______________________________________________________________________________
+# Singleton arc consistency and path consistency
+#
+# Both are stronger than AC and cost much more, so they are meant as a pre-pass
+# at the root or as inference near the top of the search tree. Their work adds
+# up in csp.consistency_stats (see consistency_stats), to be weighed against
+# the backtracking it saves.
+
+def consistency_stats(csp):
+    """Return csp.consistency_stats, creating it: singleton tests and the
+    values they pruned, path revisions, pairs removed from relations and
+    values pruned by PC2, and the time spent in SAC1 and PC2."""
+    if csp.consistency_stats is None:
+        csp.consistency_stats = {'sac_tests': 0, 'sac_prunes': 0, 'pc_revisions': 0,
+                                 'pc_pairs': 0, 'pc_prunes': 0, 'time': 0.0}
+    return csp.consistency_stats
+
+def SAC1(csp, removals=None, AC=AC3):
+    """Singleton arc consistency, SAC-1 (Debruyne & Bessiere, 1997): prune
+    Xi=x if supposing it makes AC fail, and go over all the values again
+    until a whole pass prunes nothing. Each supposition is undone with the
+    trail of the domain store (checkpoint/rollback_to) when it has one, or
+    with a removals list. Return False if a domain is wiped out."""
+    stats = consistency_stats(csp)
+    start = time.time()
+    csp.support_pruning()
+    consistent = AC(csp, None, removals)
+    changed = consistent
+    while changed:
+        changed = False
+        for X in csp.variables:
+            if len(csp.curr_domains[X]) == 1:
+                continue
+            for x in csp.curr_domains[X][:]:
+                # Propagating an earlier prune may have removed x already.
+                if x not in csp.curr_domains[X]:
+                    continue
+                stats['sac_tests'] += 1
+                mark = csp.checkpoint()
+                supposed = csp.suppose(X, x)
+                singleton = AC(csp, [(Y, X) for Y in csp.neighbors[X]], supposed)
+                if mark is None:
+                    csp.restore(supposed)
+                else:
+                    csp.rollback_to(mark)
+                if not singleton:
+                    stats['sac_prunes'] += 1
+                    csp.prune(X, x, removals)
+                    changed = True
+                    if not AC(csp, [(Y, X) for Y in csp.neighbors[X]], removals):
+                        consistent = changed = False
+                        break
+            if not consistent:
                 break
-        if counter != 0 and check:
-            if elast == e.infer_assignment():
-                t = time.time()-start_time
-                if pr:
-                    print()
-                    e.display(e.infer_assignment())
-                    print('\nSolution not found after %d iterations'%counter)
-                    print('time taken is %f seconds'%t)
+    stats['time'] += time.time() - start
+    return consistent
+
+def PC2(csp, removals=None, keep=False):
+    """Path consistency, PC-2 (Mackworth, 1977), on the bitset rows of the
+    compiled constraints (compiled here if needed): the pair Xi=x, Xj=y is
+    removed from the relation of Xi and Xj unless every Xk has a value
+    compatible with both. Values left without support are pruned, as in AC.
+    Only the triangles of the constraint graph are made path consistent, so
+    no constraints are added. The tightened relations are kept in
+    csp.relations if keep, else they only serve to prune the domains (and
+    nothing needs undoing but the removals). Return False on a wipe-out."""
+    stats = consistency_stats(csp)
+    start = time.time()
+    csp.support_pruning()
+    if csp.relations is None:
+        csp.compile_constraints()
+    relations = csp.relations if keep else dict(csp.relations)
+    values, d = csp.values, len(csp.values)
+    peers = {X: set(csp.neighbors[X]) - {X} for X in csp.variables}
+    pending = deque((Xi, Xk, Xj) for Xi in csp.variables for Xj in peers[Xi]
+                    for Xk in peers[Xi] & peers[Xj])
+    queued = set(pending)
+    if not AC3(csp, None, removals):
+        pending.clear()
+
+    def push(triple):
+        if triple not in queued:
+            queued.add(triple)
+            pending.append(triple)
+
+    consistent = True
+    while pending and consistent:
+        Xi, Xk, Xj = triple = pending.popleft()
+        queued.discard(triple)
+        stats['pc_revisions'] += 1
+        rows_ij, rows_ik, rows_kj = relations[Xi, Xj], relations[Xi, Xk], relations[Xk, Xj]
+        di, dk, dj = csp.domain_mask(Xi), csp.domain_mask(Xk), csp.domain_mask(Xj)
+        new = list(rows_ij)
+        for x in bits(di):
+            path = 0
+            for z in bits(rows_ik[x] & dk):
+                path |= rows_kj[z]
+            new[x] &= path
+        if new == list(rows_ij):
+            continue
+        stats['pc_pairs'] += sum(popcount(rows_ij[x] & ~new[x] & dj) for x in bits(di))
+        relations[Xi, Xj] = tuple(new)
+        relations[Xj, Xi] = tuple(sum(1 << x for x in range(d) if new[x] >> y & 1)
+                                  for y in range(d))
+        for Xm in peers[Xi] & peers[Xj]:
+            for t in ((Xi, Xj, Xm), (Xj, Xi, Xm), (Xm, Xi, Xj), (Xm, Xj, Xi)):
+                push(t)
+        # Values of Xi and Xj left without support on this arc go, as in AC.
+        for (A, B, rows) in ((Xi, Xj, new), (Xj, Xi, relations[Xj, Xi])):
+            db = csp.domain_mask(B)
+            for a in bits(csp.domain_mask(A)):
+                if not rows[a] & db:
+                    stats['pc_prunes'] += 1
+                    csp.prune(A, values[a], removals)
+                    for Xm in peers[A]:
+                        for Xn in peers[A] & peers[Xm]:
+                            push((Xm, A, Xn))
+            if not csp.curr_domains[A]:
+                consistent = False
                 break
-        if not check:
-            t = time.time()-start_time
-            if pr:
-                print()
-                e.display(e.infer_assignment())
-                print('\nSolution found in %d iterations'%counter)
-                print('time taken to solve is %f seconds'%t)
-            done = True
+    # The domains PC2 pruned may have cost other arcs their supports.
+    consistent = consistent and all(csp.curr_domains[X] for X in csp.variables) \
+        and AC3(csp, None, removals)
+    stats['time'] += time.time() - start
+    return consistent
+
+# ______________________________________________________________________________
+# Propagation drivers
+
+PropagationResult = namedtuple('PropagationResult', 'status iterations revisions prunes time')
+PropagationResult.__doc__ = """What a propagation driver did: status is 'solved' (every
+domain down to one value), 'unsolved' (fixpoint with some choices left) or
+'failed' (a domain was wiped out); iterations counts the domain-change
+events (or the sweeps of AC-1, or the deletions propagated by AC-4),
+revisions the calls to revise (the support counts decremented, for AC-4),
+prunes the values removed and time the wall time in seconds."""
+
+def propagate(csp, revise=revise, removals=None):
+    """Run arc consistency to its fixpoint in one pass. The events are the
+    variables whose domain changed: handling the event of Xj revises every
+    arc (Xk, Xj), and each arc that prunes Xk raises an event for Xk (once,
+    while it is pending). Works for any csp; revise may be revise or
+    revise_rm. Returns a PropagationResult."""
+    start = time.time()
+    csp.support_pruning()
+    if revise is revise_rm and csp.residues is None:
+        csp.intern()
+        csp.residues = {}
+    stats = {}
+    events = ArcQueue(csp, 'variable', stats)
+    events.extend((None, Xj) for Xj in csp.variables)
+    revisions = prunes = 0
+    status = 'unsolved'
+    while events:
+        (Xk, Xj) = events.pop()
+        revisions += 1
+        before = len(csp.curr_domains[Xk])
+        if revise(csp, Xk, Xj, removals):
+            prunes += before - len(csp.curr_domains[Xk])
+            if not csp.curr_domains[Xk]:
+                status = 'failed'
+                break
+            events.push((None, Xk))
+    if status != 'failed' and all(len(csp.curr_domains[var]) == 1 for var in csp.variables):
+        status = 'solved'
+    return PropagationResult(status, stats['pushed'], revisions, prunes, time.time() - start)
+
+def propagate_sweeps(csp, sweep=AC1, removals=None):
+    """Repeat an algorithm that does not reach the fixpoint by itself, such
+    as AC1 (one sweep over all the arcs), until a sweep prunes nothing.
+    Returns a PropagationResult; revisions is not counted (0)."""
+    start = time.time()
+    csp.support_pruning()
+    size = sum(len(csp.curr_domains[var]) for var in csp.variables)
+    initial, sweeps = size, 0
+    while True:
+        sweeps += 1
+        sweep(csp, None, removals)
+        if not all(csp.curr_domains[var] for var in csp.variables):
+            status = 'failed'
+            break
+        last, size = size, sum(len(csp.curr_domains[var]) for var in csp.variables)
+        if size == last:
+            status = 'solved' if size == len(csp.variables) else 'unsolved'
             break
-        elast = e.infer_assignment().copy()
-    return t, done
+    return PropagationResult(status, sweeps, 0, initial - size, time.time() - start)
+
+def report(e, result, name, pr):
+    """Print and return (time, solved) for the implementAC functions."""
+    if pr:
+        print()
+        e.display(e.infer_assignment())
+        if result.status == 'solved':
+            print('\n%s solved it in %d iterations' % (name, result.iterations))
+        else:
+            print('\nSolution not found after %d iterations (%s)' % (result.iterations, result.status))
+        print('%d values pruned, time taken is %f seconds' % (result.prunes, result.time))
+    return result.time, result.status == 'solved'
+
+def implementAC1(e,pr=True):
+    return report(e, propagate_sweeps(e, AC1), 'AC-1', pr)
 
 def implementAC3(e,pr=True):
-    counter = 0
+    return report(e, propagate(e), 'AC-3', pr)
+
+def implementAC4(e,pr=True):
     start_time = time.time()
-    elast = dict()
-    done = False
-    while True:
-        check = False
-        AC3(e);
-        counter += 1
-        for i in range(80):
-            if i not in e.infer_assignment():
-                check = True
-                break
-        if counter != 0 and check:
-            if elast == e.infer_assignment():
-                t = time.time()-start_time
-                if pr:
-                    print()
-                    e.display(e.infer_assignment())
-                    print('\nSolution not found')
-                    print('time taken is %f seconds'%t)                
-                break
-        if not check:
-            t = time.time()-start_time
-            if pr:
-                print()
-                e.display(e.infer_assignment())
-                print('time taken to solve is %f seconds'%t)
-            done = True
-            break             
-        elast = e.infer_assignment().copy()
-    return t, done
\ No newline at end of file
+    removals = []
+    result = AC4(e, removals=removals)
+    status = ('failed' if not result else
+              'solved' if all(len(e.curr_domains[var]) == 1 for var in e.variables) else 'unsolved')
+    return report(e, PropagationResult(status, e.ac4.deletions, e.ac4.decrements, len(removals),
+                                       time.time()-start_time), 'AC-4', pr)
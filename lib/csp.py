@@ -1,4 +1,6 @@
-from lib.utils import argmin_random_tie, count, first
+from lib.utils import argmin_random_tie, count, first, IndexedSet
+from lib.global_constraints import CompactTable
+from lib.domains import bits
 import lib.search as search
 
 from collections import defaultdict
@@ -34,8 +36,35 @@ class CSP(search.Problem):
         unassign(var, a)        Do del a[var], plus other bookkeeping
         nconflicts(var, val, a) Return the number of other variables that
                                 conflict with var=val
+        support_conflict_counts(a) Keep incremental conflict counts for a
         curr_domains[var]       Slot: remaining consistent values for var
                                 Used by constraint propagation routines.
+        checkpoint()            Return a mark for rollback_to (trail stores)
+        rollback_to(mark)       Undo domain changes made since the mark
+        intern()                Number variables and values 0..n-1, 0..d-1
+        compile_constraints()   Tabulate constraints into relations[A, B]
+        add_constraint(c)       Add an n-ary constraint object (e.g.
+                                global_constraints.AllDifferent)
+        add_table(scope, tuples) Add an extensional constraint: the allowed
+                                tuples of values, as in the textbook
+        nary_constraints        Slot: the n-ary constraints, in order added
+        var_constraints         Slot: {var: n-ary constraints on var}
+        var_checks              Slot: same, without the redundant ones;
+                                checked by nconflicts, forward_checking, mac
+        domain_store            Slot: class used to build curr_domains, e.g.
+                                domains.BitsetDomains or domains.TrailDomains;
+                                None keeps lists.
+        var_weights             Slot: {var: dead ends}, kept by restart_search
+        support_arc_weights()   Keep a weight per constraint, for dom_wdeg
+        residues                Slot: last supports found by AC3rm
+        arc_queue_stats         Slot: queue counts summed over AC3_queue calls
+        ac4                     Slot: support counters and lists of AC4
+        consistency_stats       Slot: work done by SAC1 and PC2
+        arc_matrices            Slot: NumPy arcs and relations, for
+                                AC3_vectorized
+        support_mrv_index(a)    Index the unassigned variables of a by domain
+                                size, for mrv_indexed
+        weigh_arc(A, B)         Bump the weight of the constraint A-B
     The following methods are used only by graph_search and tree_search:
         actions(state)          Return a list of actions
         result(state, action)   Return a successor of state
@@ -45,7 +74,7 @@ class CSP(search.Problem):
         display(a)              Print a human-readable representation
     """
 
-    def __init__(self, variables, domains, neighbors, constraints):
+    def __init__(self, variables, domains, neighbors, constraints, domain_store=None):
         """Construct a CSP problem. If variables is empty, it becomes domains.keys()."""
         variables = variables or list(domains.keys())
 
@@ -55,11 +84,37 @@ class CSP(search.Problem):
         self.constraints = constraints
         self.initial = ()
         self.curr_domains = None
+        self.domain_store = domain_store
+        self.relations = None
+        self.var_index = None
+        self.conflict_counts = None
+        self.initial_masks = None
+        self.var_weights = None
+        self.nary_constraints = []
+        self.var_constraints = {}
+        self.var_checks = {}
+        self.arc_weights = None
+        self.mrv_index = None
+        self.residues = None
+        self.arc_queue_stats = None
+        self.ac4 = None
+        self.consistency_stats = None
+        self.arc_matrices = None
         self.nassigns = 0
 
     def assign(self, var, val, assignment):
         """Add {var: val} to assignment; Discard the old value if any."""
-        assignment[var] = val
+        if self.conflict_counts is not None and assignment is self.counted:
+            if var in assignment:
+                self.count_conflicts(var, assignment[var], -1)
+            assignment[var] = val
+            self.count_conflicts(var, val, +1)
+            if self.var_checks:
+                self.recheck_conflicted(var)
+        else:
+            assignment[var] = val
+        if self.mrv_index is not None and assignment is self.indexed:
+            self.mrv_index.discard(var)
         self.nassigns += 1
 
     def unassign(self, var, assignment):
@@ -67,7 +122,14 @@ class CSP(search.Problem):
         DO NOT call this if you are changing a variable to a new value;
         just call assign for that."""
         if var in assignment:
+            if self.conflict_counts is not None and assignment is self.counted:
+                self.count_conflicts(var, assignment[var], -1)
+                self.conflicted.discard(var)
             del assignment[var]
+            if self.conflict_counts is not None and assignment is self.counted and self.var_checks:
+                self.recheck_conflicted(var)
+            if self.mrv_index is not None and assignment is self.indexed:
+                self.mrv_index.add(var, len(self.curr_domains[var]))
 
     def is_consistent(self, var, val, assignment):
         """Return if var=val conflicts with other variables."""
@@ -77,10 +139,39 @@ class CSP(search.Problem):
     def nconflicts(self, var, val, assignment):
         """Return the number of conflicts var=val has with other variables."""
         # Subclasses may implement this more efficiently
-        def conflict(var2):
-            return (var2 in assignment and
-                    not self.constraints(var, val, var2, assignment[var2]))
-        return count(conflict(v) for v in self.neighbors[var])
+        if self.conflict_counts is not None and assignment is self.counted:
+            n = self.counted_nconflicts(var, val)
+        elif self.relations is not None:
+            index = self.value_index
+            j = index[val]
+            n = count(var2 in assignment and
+                      not self.relations[var, var2][j] >> index[assignment[var2]] & 1
+                      for var2 in self.neighbors[var])
+        else:
+            def conflict(var2):
+                return (var2 in assignment and
+                        not self.constraints(var, val, var2, assignment[var2]))
+            n = count(conflict(v) for v in self.neighbors[var])
+        if self.var_checks:
+            n += count(c.conflicts(var, val, assignment) for c in self.var_checks.get(var, ()))
+        return n
+
+    def add_constraint(self, constraint, redundant=False):
+        """Add an n-ary constraint: an object with a scope (tuple of variables)
+        and a propagate(csp, removals) method, see lib.global_constraints.
+        A redundant constraint, implied by the binary ones, is only used
+        for propagation, not checked by nconflicts."""
+        self.nary_constraints.append(constraint)
+        for var in constraint.scope:
+            self.var_constraints.setdefault(var, []).append(constraint)
+            if not redundant:
+                self.var_checks.setdefault(var, []).append(constraint)
+
+    def add_table(self, scope, tuples):
+        """Add the constraint that the values of scope form one of tuples,
+        e.g. add_table(('A', 'B', 'C'), [(1, 2, 3), (2, 3, 1)]). It is
+        propagated by Compact-Table, see global_constraints.CompactTable."""
+        self.add_constraint(CompactTable(scope, tuples))
 
     def display(self, assignment):
         """Show a human-readable representation of the CSP."""
@@ -118,18 +209,30 @@ class CSP(search.Problem):
         """Make sure we can prune values from domains. (We want to pay
         for this only if we use it.)"""
         if self.curr_domains is None:
-            self.curr_domains = {v: list(self.domains[v]) for v in self.variables}
+            if self.domain_store is None:
+                self.curr_domains = {v: list(self.domains[v]) for v in self.variables}
+            else:
+                self.curr_domains = self.domain_store(self)
 
     def suppose(self, var, value):
         """Start accumulating inferences from assuming var=value."""
         self.support_pruning()
+        if self.domain_store is not None:
+            return self.curr_domains.suppose(var, value)
         removals = [(var, a) for a in self.curr_domains[var] if a != value]
         self.curr_domains[var] = [value]
+        if self.mrv_index is not None:
+            self.mrv_index.resize(var, 1)
         return removals
 
     def prune(self, var, value, removals):
         """Rule out var=value."""
-        self.curr_domains[var].remove(value)
+        if self.domain_store is None:
+            self.curr_domains[var].remove(value)
+            if self.mrv_index is not None:
+                self.mrv_index.resize(var, len(self.curr_domains[var]))
+        else:
+            self.curr_domains.prune(var, value)
         if removals is not None:
             removals.append((var, value))
 
@@ -145,16 +248,239 @@ class CSP(search.Problem):
 
     def restore(self, removals):
         """Undo a supposition and all inferences from it."""
-        for B, b in removals:
-            self.curr_domains[B].append(b)
+        if removals is None:
+            return
+        if self.domain_store is None:
+            for B, b in removals:
+                self.curr_domains[B].append(b)
+                if self.mrv_index is not None:
+                    self.mrv_index.resize(B, len(self.curr_domains[B]))
+        else:
+            for B, b in removals:
+                self.curr_domains.restore(B, b)
+
+    def checkpoint(self):
+        """Return a mark to undo domain changes with rollback_to, or None
+        if the domain store keeps no trail (then use suppose/restore)."""
+        self.support_pruning()
+        if getattr(self.curr_domains, 'trail', None) is None:
+            return None
+        return self.curr_domains.checkpoint()
+
+    def rollback_to(self, mark):
+        """Undo every domain change made since checkpoint() returned mark."""
+        self.curr_domains.rollback_to(mark)
+
+    def domain_mask(self, var):
+        """Return the current domain of var as a bitmask over the values
+        numbered by intern."""
+        if self.domain_store is not None:
+            return self.curr_domains.masks[self.curr_domains.index[var]]
+        index = self.value_index
+        mask = 0
+        for val in self.curr_domains[var]:
+            mask |= 1 << index[val]
+        return mask
+
+    # These are for integer interning
+
+    def intern(self):
+        """Number the variables 0..n-1 (in the order of self.variables) and
+        the values 0..d-1 (in the order they first appear in the domains), so
+        that solvers can keep their state in lists indexed by integers:
+            var_index[var], values[j], value_index[val]
+            neighbor_index[i]   Indexes of the neighbors of variable i
+            domain_index[i]     Indexes of the initial values of variable i
+        Solvers translate back with decode_assignment. Safe to call again."""
+        if self.var_index is not None:
+            return
+        values, value_index = [], {}
+        for var in self.variables:
+            for val in self.domains[var]:
+                if val not in value_index:
+                    value_index[val] = len(values)
+                    values.append(val)
+        self.values = values
+        self.value_index = value_index
+        self.var_index = {var: i for i, var in enumerate(self.variables)}
+        self.neighbor_index = [[self.var_index[B] for B in self.neighbors[A]]
+                               for A in self.variables]
+        self.domain_index = [[value_index[val] for val in self.domains[var]]
+                             for var in self.variables]
+
+    def encode_assignment(self, assignment):
+        """Return assignment as a list of value indexes, None where unassigned."""
+        self.intern()
+        encoded = [None] * len(self.variables)
+        for var, val in assignment.items():
+            encoded[self.var_index[var]] = self.value_index[val]
+        return encoded
+
+    def decode_assignment(self, encoded):
+        """Inverse of encode_assignment: return the {var: val} dict."""
+        return {self.variables[i]: self.values[j]
+                for i, j in enumerate(encoded) if j is not None}
+
+    # This is for compiled constraints
+
+    def compile_constraints(self, key=None):
+        """Evaluate the constraints function once per relation and store it as
+        allowed-pair tables: relations[A, B][j] is the bitmask of the values B
+        may take when A takes value number j (numbered as in intern).
+        Arcs for which key(A, B) is equal are assumed to share the same
+        relation, and arcs with identical tables share one table object, so
+        memory is O(distinct relations). Return the number of tables."""
+        self.intern()
+        values = self.values
+        by_key, tables, relations = {}, {}, {}
+        for A in self.variables:
+            for B in self.neighbors[A]:
+                k = (A, B) if key is None else key(A, B)
+                rows = by_key.get(k)
+                if rows is None:
+                    rows = tuple(sum(1 << j for j, b in enumerate(values)
+                                     if self.constraints(A, a, B, b))
+                                 for a in values)
+                    rows = by_key[k] = tables.setdefault(rows, rows)
+                relations[A, B] = rows
+        self.relations = relations
+        return len(tables)
+
+    # These are for constraint weighting
+
+    def support_arc_weights(self):
+        """Number the constraints (the arcs A-B and B-A share a number) and
+        keep a weight for each in the list arc_weights, starting at 1:
+            arc_index[A, B]     Number of the constraint between A and B
+            var_arcs[i]         (j, k) for each neighbor j of variable i,
+                                k being the number of their constraint
+        A variable listed as its own neighbor (as in NQueensCSP) gets no
+        constraint number for it. Propagation calls weigh_arc when it wipes
+        out a domain. Safe to call again; the weights are kept."""
+        if self.arc_weights is not None:
+            return
+        self.intern()
+        arc_index, m = {}, 0
+        for A in self.variables:
+            for B in self.neighbors[A]:
+                if A != B and (A, B) not in arc_index:
+                    arc_index[A, B] = arc_index[B, A] = m
+                    m += 1
+        self.arc_index = arc_index
+        self.var_arcs = [[(self.var_index[B], arc_index[A, B]) for B in self.neighbors[A] if B != A]
+                         for A in self.variables]
+        self.arc_weights = [1] * m
+
+    def weigh_arc(self, A, B):
+        """Count a wipe-out of a domain by the constraint between A and B."""
+        if A != B:
+            self.arc_weights[self.arc_index[A, B]] += 1
+
+    # This is for indexed variable selection
+
+    def support_mrv_index(self, assignment):
+        """Index the variables not in assignment by the size of their current
+        domain (a domains.SizeBuckets in self.mrv_index), so that the smallest
+        domain is found without a scan. prune, restore, suppose and the domain
+        stores keep the sizes; assign and unassign on this assignment take
+        variables out of the index and put them back."""
+        from lib.domains import SizeBuckets
+        self.support_pruning()
+        self.indexed = assignment
+        self.mrv_index = SizeBuckets(((var, len(self.curr_domains[var]))
+                                      for var in self.variables if var not in assignment),
+                                     max(len(self.domains[var]) for var in self.variables))
+        if self.domain_store is not None:
+            self.curr_domains.sizes = self.mrv_index
 
     # This is for min_conflicts search
 
     def conflicted_vars(self, current):
         """Return a list of variables in current assignment that are in conflict"""
+        if self.conflict_counts is not None and current is self.counted:
+            return list(self.conflicted)
         return [var for var in self.variables
                 if self.nconflicts(var, current[var], current) > 0]
 
+    # These are for incremental conflict counts
+
+    def support_conflict_counts(self, assignment):
+        """Keep a table of conflict counts for the given assignment dict, so
+        that nconflicts, is_consistent and conflicted_vars on it take O(1)
+        (or O(#conflicted)) instead of rescanning the neighbors. The table is
+        updated by assign and unassign, so the assignment must only be changed
+        through them. Assumes neighbors and constraints are symmetric. The
+        checked n-ary constraints are not tabulated: nconflicts adds theirs,
+        and assign and unassign recheck the variables that share one.
+        The conflicted variables are kept in self.conflicted, an IndexedSet.
+        Subclasses may keep the counts more efficiently by overriding this,
+        count_conflicts and counted_nconflicts."""
+        self.intern()
+        self.counted = assignment
+        self.conflict_counts = [{} for _ in self.variables]
+        # The initial domain of each variable as a mask of value numbers.
+        self.initial_masks = [sum(1 << b for b in values) for values in self.domain_index]
+        self.conflicted = IndexedSet()
+        for var, val in assignment.items():
+            self.count_conflicts(var, val, +1)
+        if self.var_checks:
+            for var in assignment:
+                self.recheck_conflicted(var)
+
+    def recheck_conflicted(self, var):
+        """Update the conflicted set for var and the variables that share a
+        constraint with it, from nconflicts, n-ary constraints included."""
+        assignment = self.counted
+        for X in set(self.neighbors[var]).union([var], *(c.scope for c in self.var_checks.get(var, ()))):
+            if X in assignment and self.nconflicts(X, assignment[X], assignment):
+                self.conflicted.add(X)
+            else:
+                self.conflicted.discard(X)
+
+    def counted_nconflicts(self, var, val):
+        """nconflicts(var, val, a) read from the table kept for a."""
+        return self.conflict_counts[self.var_index[var]].get(self.value_index[val], 0)
+
+    def count_conflicts(self, var, val, delta):
+        """Add delta to the conflict count of every value of every neighbor
+        of var that conflicts with var=val. O(deg + conflicting values) per
+        call when the constraints are compiled (only the clear bits of the
+        table rows are visited), O(deg * d) constraint calls otherwise."""
+        index = self.value_index
+        j = index[val]
+        for B in self.neighbors[var]:
+            counts = self.conflict_counts[self.var_index[B]]
+            if self.relations is not None:
+                row = self.relations[var, B][j]
+                conflicting = bits(~row & self.initial_masks[self.var_index[B]])
+            else:
+                conflicting = (index[b] for b in self.domains[B]
+                               if not self.constraints(var, val, B, b))
+            for b in conflicting:
+                n = counts.get(b, 0) + delta
+                if n:
+                    counts[b] = n
+                else:
+                    del counts[b]
+                if B in self.counted and index[self.counted[B]] == b:
+                    if n:
+                        self.conflicted.add(B)
+                    else:
+                        self.conflicted.discard(B)
+        if var in self.counted and self.counted[var] == val:
+            if self.conflict_counts[self.var_index[var]].get(j, 0):
+                self.conflicted.add(var)
+            else:
+                self.conflicted.discard(var)
+
+    def sample_values(self, var, k):
+        """Generate k random values (maybe repeated) from the domain of var,
+        for local search on big domains. Subclasses may prefer more
+        promising values."""
+        domain = self.domains[var]
+        for _ in range(k):
+            yield domain[int(random.random() * len(domain))]
+
     # Only used for tracking pruned domains for visualization.
     def track_pruned_domain_for_display(self):
         return
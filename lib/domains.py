@@ -0,0 +1,192 @@
+"""Domain stores for CSP.curr_domains.
+
+By default CSP.support_pruning keeps every current domain as a Python list,
+so pruning a value is an O(d) list.remove. The stores in this module keep the
+same {var: domain} interface, but represent each domain as an integer bitmask
+over the interned values of the CSP: pruning and restoring a value are single
+bit operations, and the size of a domain is a popcount.
+
+Reading csp.curr_domains[var] returns a tuple snapshot of the values left,
+so code that only iterates, sizes or indexes domains runs unchanged. Changes
+must go through CSP.prune, CSP.restore and CSP.suppose (or the store itself).
+
+TrailDomains additionally records every change on a trail (undo stack), so a
+search can take a checkpoint() once per decision and undo everything after it
+with rollback_to(mark), instead of collecting and replaying removals lists.
+
+To use one, pass it to the CSP (or set the slot before solving):
+    >>> e = Sudoku(easy1)
+    >>> e.domain_store = BitsetDomains
+    >>> AC3(e)
+    True
+
+SizeBuckets indexes the unassigned variables by domain size, for MRV
+selection without a scan (see CSP.support_mrv_index). The stores keep it
+up to date in set_mask.
+"""
+
+from lib.utils import IndexedSet
+
+try:
+    popcount = int.bit_count  # Python 3.10+
+except AttributeError:
+    def popcount(mask):
+        """Return the number of bits set in mask."""
+        return bin(mask).count('1')
+
+
+def bits(mask):
+    """Yield the index of every bit set in mask, lowest first."""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class BitsetDomains(dict):
+    """A {var: values} mapping where each domain is kept as an int bitmask.
+    Variables and values are numbered by CSP.intern; value number j is
+    represented by bit (1 << j). The dict itself holds
+    the decoded tuple for each mask, so reads cost a plain dict lookup."""
+
+    # Decoded masks are memoized; the memo is dropped when it gets this big.
+    max_memo = 1 << 16
+
+    def __init__(self, csp):
+        csp.intern()
+        self.variables = csp.variables
+        self.index = csp.var_index
+        self.values = csp.values
+        self.bit = {val: 1 << j for val, j in csp.value_index.items()}
+        self.memo = {}
+        self.sizes = None
+        self.masks = [0] * len(self.variables)
+        for i, var in enumerate(self.variables):
+            self.set_mask(i, self.mask(csp.domains[var]))
+
+    def decode(self, mask):
+        """Return the tuple of values whose bits are set in mask."""
+        try:
+            return self.memo[mask]
+        except KeyError:
+            if len(self.memo) >= self.max_memo:
+                self.memo.clear()
+            values = self.values
+            result = self.memo[mask] = tuple(values[j] for j in bits(mask))
+            return result
+
+    def mask(self, values):
+        """Return the bitmask representing the given values."""
+        m = 0
+        for val in values:
+            m |= self.bit[val]
+        return m
+
+    def set_mask(self, i, mask):
+        """Replace the domain of variable number i. All changes go through here."""
+        self.masks[i] = mask
+        values = self.decode(mask)
+        dict.__setitem__(self, self.variables[i], values)
+        if self.sizes is not None:
+            self.sizes.resize(self.variables[i], len(values))
+
+    def prune(self, var, value):
+        """Remove value from the domain of var."""
+        i = self.index[var]
+        bit = self.bit[value]
+        if not self.masks[i] & bit:
+            raise ValueError('{} is not in the domain of {}'.format(value, var))
+        self.set_mask(i, self.masks[i] & ~bit)
+
+    def restore(self, var, value):
+        """Put value back in the domain of var."""
+        i = self.index[var]
+        self.set_mask(i, self.masks[i] | self.bit[value])
+
+    def suppose(self, var, value):
+        """Reduce the domain of var to [value]; return the removed (var, val) pairs."""
+        removals = [(var, a) for a in self[var] if a != value]
+        self.set_mask(self.index[var], self.bit[value])
+        return removals
+
+    def __setitem__(self, var, values):
+        self.set_mask(self.index[var], self.mask(values))
+
+
+class TrailDomains(BitsetDomains):
+    """A BitsetDomains store that records the old mask of every change on a
+    trail. With this store CSP.suppose returns None instead of a removals
+    list; undo domain changes with checkpoint() and rollback_to(mark)."""
+
+    def __init__(self, csp):
+        self.trail = None
+        BitsetDomains.__init__(self, csp)
+        self.trail = []
+
+    def set_mask(self, i, mask):
+        if self.trail is not None and mask != self.masks[i]:
+            self.trail.append((i, self.masks[i]))
+        BitsetDomains.set_mask(self, i, mask)
+
+    def suppose(self, var, value):
+        self.set_mask(self.index[var], self.bit[value])
+        return None
+
+    def checkpoint(self):
+        """Return a mark for the current state of the domains."""
+        return len(self.trail)
+
+    def rollback_to(self, mark):
+        """Undo every change recorded since checkpoint() returned mark."""
+        trail = self.trail
+        for k in range(len(trail) - 1, mark - 1, -1):
+            i, mask = trail[k]
+            BitsetDomains.set_mask(self, i, mask)
+        del trail[mark:]
+
+
+class SizeBuckets:
+    """Variables bucketed by the size of their domain: buckets[k] is an
+    IndexedSet of the variables with k values left. smallest() returns a
+    random variable of the smallest non-empty bucket, in O(1) amortised:
+    low is a lower bound on that size, lowered by resize and raised
+    lazily by smallest()."""
+
+    def __init__(self, sizes, max_size):
+        self.buckets = [IndexedSet() for _ in range(max_size + 1)]
+        self.size = {}
+        self.low = max_size
+        for var, k in sizes:
+            self.add(var, k)
+
+    def add(self, var, k):
+        """Index var with domain size k."""
+        self.size[var] = k
+        self.buckets[k].add(var)
+        if k < self.low:
+            self.low = k
+
+    def discard(self, var):
+        """Stop indexing var (e.g. because it is assigned)."""
+        k = self.size.pop(var, None)
+        if k is not None:
+            self.buckets[k].discard(var)
+
+    def resize(self, var, k):
+        """Move var to bucket k, if it is indexed."""
+        old = self.size.get(var)
+        if old is not None and old != k:
+            self.buckets[old].discard(var)
+            self.add(var, k)
+
+    def smallest(self):
+        """Return a random variable with the smallest domain, or None."""
+        buckets = self.buckets
+        while self.low < len(buckets) and not buckets[self.low]:
+            self.low += 1
+        if self.low == len(buckets):
+            return None
+        return buckets[self.low].choice()
+
+    def __len__(self):
+        return len(self.size)
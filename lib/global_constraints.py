@@ -0,0 +1,551 @@
+"""N-ary constraints for CSP.
+
+A constraint object has a scope, the tuple of variables it constrains,
+and holds(values) saying whether a tuple of values for the scope satisfies
+it. Its propagate(csp, removals) method prunes the current domains of the
+scope (through csp.prune, so that removals and trails work as for AC3) to
+generalized arc consistency, or less for the cheaper ones, and returns
+False if a domain is wiped out; forward_check does the (cheaper) pruning of
+forward checking after a variable of the scope is assigned.
+
+Constraints are declared with CSP.add_constraint, which indexes them by
+variable in csp.var_constraints. nconflicts (and so backtracking_search,
+goal_test, ...), forward_checking and mac then take them into account,
+unless they were declared redundant, i.e. implied by the binary
+constraints, in which case only the n-ary propagators (propagate_constraints
+and the gac inference) use them. Sudoku declares its units that way:
+    >>> e = Sudoku(easy1)
+    >>> len(e.nary_constraints)
+    27
+    >>> propagate_constraints(e)
+    True
+"""
+
+from lib.domains import bits, popcount
+from collections import deque
+import itertools
+import numpy as np
+
+
+class Constraint:
+    """The variables of scope must take values for which predicate(*values)
+    is true. propagate enforces GAC by looking for a supporting tuple for
+    every value (a generic GAC schema), remembering the last support found
+    for each value as a residue to try first next time; it costs up to the
+    product of the domain sizes, so subclasses propagate more cleverly.
+    Subclasses define holds as a method instead of a predicate, so that the
+    constraint (and the csp) can be pickled, e.g. for lib.parallel."""
+
+    def __init__(self, scope, predicate=None):
+        self.scope = tuple(scope)
+        self.predicate = predicate
+        self.residues = {}
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, list(self.scope))
+
+    def holds(self, values):
+        """Is the constraint satisfied by values, a tuple for the scope?"""
+        return self.predicate(*values)
+
+    def conflicts(self, var, val, assignment):
+        """Is var=val, with assignment, a violation of the constraint? Only
+        when the whole scope is assigned."""
+        values = []
+        for X in self.scope:
+            if X == var:
+                values.append(val)
+            elif X in assignment:
+                values.append(assignment[X])
+            else:
+                return False
+        return not self.holds(values)
+
+    def satisfied(self, assignment):
+        """Is the constraint not violated by assignment (maybe partial)?"""
+        if all(X in assignment for X in self.scope):
+            return self.holds([assignment[X] for X in self.scope])
+        return True
+
+    def forward_check(self, csp, var, assignment, removals=None):
+        """After var is assigned: if one variable of the scope is left
+        unassigned, prune its values that violate the constraint."""
+        free = [X for X in self.scope if X not in assignment]
+        if len(free) != 1:
+            return True
+        Y = free[0]
+        for y in csp.curr_domains[Y][:]:
+            if self.conflicts(Y, y, assignment):
+                csp.prune(Y, y, removals)
+        return bool(csp.curr_domains[Y])
+
+    def propagate(self, csp, removals=None):
+        """Remove the values that have no supporting tuple."""
+        domains = csp.curr_domains
+        residues = self.residues
+        for i, X in enumerate(self.scope):
+            for x in domains[X][:]:
+                support = residues.get((X, x))
+                if support is not None and all(v in domains[Y] for Y, v in zip(self.scope, support)):
+                    continue
+                support = next((t for t in itertools.product(*[
+                    (x,) if j == i else domains[Y] for j, Y in enumerate(self.scope)])
+                    if self.holds(t)), None)
+                if support is None:
+                    csp.prune(X, x, removals)
+                else:
+                    for Y, v in zip(self.scope, support):
+                        residues[Y, v] = support
+            if not domains[X]:
+                return False
+        return True
+
+
+class Table(Constraint):
+    """The values of the scope must form one of the given tuples.
+    propagate scans the tuples once, keeping those whose values are all
+    still in the domains, and removes the values found in none (STR,
+    Ullmann, 2007). For big tables, use CompactTable."""
+
+    def __init__(self, scope, tuples):
+        Constraint.__init__(self, scope)
+        self.tuples = [tuple(t) for t in tuples]
+        self.allowed = set(self.tuples)
+
+    def holds(self, values):
+        return tuple(values) in self.allowed
+
+    def propagate(self, csp, removals=None):
+        domains = [set(csp.curr_domains[X]) for X in self.scope]
+        supported = [set() for _ in self.scope]
+        for t in self.tuples:
+            if all(v in d for v, d in zip(t, domains)):
+                for v, s in zip(t, supported):
+                    s.add(v)
+        for X, d, s in zip(self.scope, domains, supported):
+            for x in d - s:
+                csp.prune(X, x, removals)
+            if not s:
+                return False
+        return True
+
+
+class Sum(Constraint):
+    """low <= sum(weights[i] * scope[i]) <= high, over numeric domains
+    (weights default to 1). propagate removes a value if even with the
+    smallest (or largest) contributions of the other variables the sum
+    leaves [low, high]; O(sum of domain sizes) per pass. This is bounds
+    reasoning, not GAC, which is NP-hard for sums."""
+
+    def __init__(self, scope, low=None, high=None, weights=None):
+        Constraint.__init__(self, scope)
+        self.weights = tuple(weights) if weights is not None else (1,) * len(self.scope)
+        self.low = low if low is not None else float('-inf')
+        self.high = high if high is not None else float('inf')
+
+    def holds(self, values):
+        return self.low <= sum(w * v for w, v in zip(self.weights, values)) <= self.high
+
+    def forward_check(self, csp, var, assignment, removals=None):
+        return self.propagate(csp, removals)
+
+    def propagate(self, csp, removals=None):
+        domains = csp.curr_domains
+        changed = True
+        while changed:
+            changed = False
+            terms = [[w * v for v in domains[X]] for w, X in zip(self.weights, self.scope)]
+            if not all(terms):
+                return False
+            lows, highs = [min(t) for t in terms], [max(t) for t in terms]
+            total_low, total_high = sum(lows), sum(highs)
+            if total_low > self.high or total_high < self.low:
+                return False
+            for w, X, l, h in zip(self.weights, self.scope, lows, highs):
+                rest_low, rest_high = total_low - l, total_high - h
+                for x in domains[X][:]:
+                    if rest_low + w * x > self.high or rest_high + w * x < self.low:
+                        csp.prune(X, x, removals)
+                        changed = True
+                if changed:
+                    break
+        return True
+
+
+class CompactTable(Constraint):
+    """The values of the scope must form one of the given tuples, for big
+    tables: propagated by Compact-Table (Demeulenaere et al., 2016).
+    The tuples are kept in one contiguous array, tuples[k, i] being the
+    position of the value of scope[i] in values[i]. The tuples still valid
+    are a bitset of NumPy uint64 words, of which only the nonzero ones,
+    words[index[:limit]], are visited, and supports[i][p] is the bitset of
+    the tuples where scope[i] takes its value number p. propagate removes
+    from the table the tuples of the values pruned since the last call (or
+    keeps those of the values left, if fewer), then keeps each value that
+    still has a tuple, looking first in the word where it had one last time.
+    The domains are only seen through csp.curr_domains, so the table is made
+    reversible the way AC4 syncs: every change goes on a trail with the
+    domains it was made for, and entries are undone when a later call finds
+    values that the search has put back."""
+
+    def __init__(self, scope, tuples):
+        Constraint.__init__(self, scope)
+        table = np.asarray(tuples).reshape(-1, len(self.scope))
+        columns = [np.unique(table[:, i], return_inverse=True) for i in range(len(self.scope))]
+        self.values = [values.tolist() for values, _ in columns]
+        self.positions = [{v: p for p, v in enumerate(values)} for values in self.values]
+        self.tuples = np.stack([inverse.reshape(-1) for _, inverse in columns], axis=1).astype(np.int32)
+        n = len(self.tuples)
+        k = np.arange(n)
+        word, bit = k >> 6, np.left_shift(np.uint64(1), (k & 63).astype(np.uint64))
+        self.supports = []
+        for i, values in enumerate(self.values):
+            support = np.zeros((len(values), max(1, (n + 63) // 64)), np.uint64)
+            np.bitwise_or.at(support, (self.tuples[:, i], word), bit)
+            self.supports.append(support)
+        self.full = np.zeros(max(1, (n + 63) // 64), np.uint64)
+        np.bitwise_or.at(self.full, word, bit)
+        self.reset()
+
+    def reset(self):
+        """Make every tuple valid again, and forget the trail."""
+        self.words = self.full.copy()
+        self.index = np.arange(len(self.words))
+        self.limit = int(np.count_nonzero(self.words))
+        self.seen = [(1 << len(values)) - 1 for values in self.values]
+        self.trail = []
+        self.residues = [np.zeros(len(values), np.intp) for values in self.values]
+
+    def holds(self, values):
+        words = None
+        for i, v in enumerate(values):
+            p = self.positions[i].get(v)
+            if p is None:
+                return False
+            words = self.supports[i][p] if words is None else words & self.supports[i][p]
+        return bool(words.any())
+
+    def forward_check(self, csp, var, assignment, removals=None):
+        return self.propagate(csp, removals)
+
+    def propagate(self, csp, removals=None):
+        domains = csp.curr_domains
+        doms, present = [], []
+        for i, X in enumerate(self.scope):
+            position, mask, ps = self.positions[i], 0, []
+            for x in list(domains[X]):
+                if x in position:
+                    ps.append(position[x])
+                    mask |= 1 << position[x]
+                else:
+                    csp.prune(X, x, removals)
+            if not mask:
+                return False
+            doms.append(mask)
+            present.append(ps)
+        # Undo the changes made for domains the search has since restored.
+        while any(d & ~s for d, s in zip(doms, self.seen)):
+            if not self.trail:
+                self.reset()
+                break
+            self.seen, self.limit, live, words = self.trail.pop()
+            self.words[live] = words
+        changed = [i for i, (d, s) in enumerate(zip(doms, self.seen)) if s & ~d]
+        if not changed:
+            return self.limit > 0
+        # Update the table, recording it on the trail.
+        live = self.index[:self.limit].copy()
+        old = self.words[live]
+        self.trail.append((self.seen, self.limit, live, old))
+        words = old.copy()
+        for i in changed:
+            removed = self.seen[i] & ~doms[i]
+            if popcount(removed) <= popcount(doms[i]):
+                words &= ~np.bitwise_or.reduce(self.supports[i][list(bits(removed))])[live]
+            else:
+                words &= np.bitwise_or.reduce(self.supports[i][present[i]])[live]
+        self.words[live] = words
+        nonzero = words != 0
+        if not nonzero.all():
+            self.index[:self.limit] = np.concatenate((live[nonzero], live[~nonzero]))
+            self.limit = int(np.count_nonzero(nonzero))
+        self.seen = doms
+        if not self.limit:
+            return False
+        # Filter the domains; those of a lone changed variable keep their supports.
+        live = self.index[:self.limit]
+        words = self.words[live]
+        for i, X in enumerate(self.scope):
+            if changed == [i]:
+                continue
+            support, residues = self.supports[i], self.residues[i]
+            ps = np.array(present[i])
+            lost = ps[(support[ps, residues[ps]] & self.words[residues[ps]]) == 0]
+            for p in lost:
+                found = (support[p, live] & words) != 0
+                k = found.argmax()
+                if found[k]:
+                    residues[p] = live[k]
+                else:
+                    csp.prune(X, self.values[i][p], removals)
+                    doms[i] &= ~(1 << int(p))
+            if not doms[i]:
+                return False
+        return True
+
+
+class AllDifferent(Constraint):
+    """The variables of scope take pairwise different values.
+    propagate enforces generalized arc consistency (Regin, 1994): a value
+    is kept iff some maximum matching of the variables to their values
+    uses it. The matching found is kept in self.match and repaired on the
+    next call, so a call after a few prunings costs little more than the
+    strongly connected components. propagate_bounds only enforces bounds
+    consistency (over the sorted values), with Hall intervals."""
+
+    def __init__(self, scope):
+        Constraint.__init__(self, scope)
+        self.match = {}
+        self.rank = None
+
+    def holds(self, values):
+        return len(set(values)) == len(values)
+
+    def conflicts(self, var, val, assignment):
+        """Any other variable of the scope already assigned val?"""
+        return any(X != var and X in assignment and assignment[X] == val
+                   for X in self.scope)
+
+    def satisfied(self, assignment):
+        """Are the assigned variables of the scope all different?"""
+        values = [assignment[X] for X in self.scope if X in assignment]
+        return len(values) == len(set(values))
+
+    def forward_check(self, csp, var, assignment, removals=None):
+        """Remove the value of var from the other unassigned variables."""
+        val = assignment[var]
+        for X in self.scope:
+            if X not in assignment and val in csp.curr_domains[X]:
+                csp.prune(X, val, removals)
+                if not csp.curr_domains[X]:
+                    return False
+        return True
+
+    def propagate(self, csp, removals=None):
+        """Remove every value that belongs to no maximum matching."""
+        domains = csp.curr_domains
+        scope = self.scope
+        if not self.maximum_matching(domains):
+            return False
+        match = self.match
+        # Graph: variable i -> its matched value; value -> the other variables
+        # that have it. Vertices 0..k-1 are the variables, k.. the values.
+        k = len(scope)
+        value_ids = {}
+        for X in scope:
+            for val in domains[X]:
+                if val not in value_ids:
+                    value_ids[val] = k + len(value_ids)
+        adj = [[value_ids[match[X]]] for X in scope] + [[] for _ in value_ids]
+        for i, X in enumerate(scope):
+            for val in domains[X]:
+                if val != match[X]:
+                    adj[value_ids[val]].append(i)
+        # Edges on an alternating path from a free value are in some matching.
+        matched = {value_ids[match[X]] for X in scope}
+        reached = [False] * len(adj)
+        frontier = [v for v in value_ids.values() if v not in matched]
+        for v in frontier:
+            reached[v] = True
+        while frontier:
+            u = frontier.pop()
+            for w in adj[u]:
+                if not reached[w]:
+                    reached[w] = True
+                    frontier.append(w)
+        # So are the edges inside a strongly connected component.
+        component = strongly_connected_components(adj)
+        for i, X in enumerate(scope):
+            for val in domains[X][:]:
+                v = value_ids[val]
+                if val != match[X] and not reached[v] and component[v] != component[i]:
+                    csp.prune(X, val, removals)
+        return True
+
+    def maximum_matching(self, domains):
+        """Repair self.match into a matching of every variable of the scope
+        to a value of its domain, by augmenting paths. False if none."""
+        match = self.match
+        owner = {}
+        for X in self.scope:
+            val = match.get(X)
+            if val is not None and val in domains[X] and val not in owner:
+                owner[val] = X
+            else:
+                match.pop(X, None)
+        for X in self.scope:
+            if X not in match and not self.augment(X, domains, owner):
+                return False
+        return True
+
+    def augment(self, X, domains, owner):
+        """Match X by a breadth first search for an alternating path that
+        ends on a free value, and flip the path."""
+        match = self.match
+        parent = {}
+        frontier = deque([X])
+        while frontier:
+            Y = frontier.popleft()
+            for val in domains[Y]:
+                if val in parent or val == match.get(Y):
+                    continue
+                parent[val] = Y
+                Z = owner.get(val)
+                if Z is None:
+                    # Flip the path back to X.
+                    while val is not None:
+                        Y = parent[val]
+                        previous = match.get(Y)
+                        match[Y] = val
+                        owner[val] = Y
+                        val = previous
+                    return True
+                frontier.append(Z)
+        return False
+
+    def propagate_bounds(self, csp, removals=None):
+        """Bounds consistency: if the bounds of m variables all lie in an
+        interval [L, U] of m values (a Hall interval), the other variables
+        cannot take a value in it. The value of a variable with a single
+        value left is also removed from the others, as bounds alone would
+        only do at their ends. O(k^2) per pass over the k variables."""
+        domains = csp.curr_domains
+        if self.rank is None:
+            universe = sorted({val for X in self.scope for val in csp.domains[X]})
+            self.rank = {val: r for r, val in enumerate(universe)}
+        rank = self.rank
+        changed = True
+        while changed:
+            changed = False
+            for X in self.scope:
+                if len(domains[X]) == 1:
+                    val = domains[X][0]
+                    for Y in self.scope:
+                        if Y != X and val in domains[Y]:
+                            csp.prune(Y, val, removals)
+                            if not domains[Y]:
+                                return False
+            lo, hi = {}, {}
+            for X in self.scope:
+                if not domains[X]:
+                    return False
+                ranks = [rank[val] for val in domains[X]]
+                lo[X], hi[X] = min(ranks), max(ranks)
+            by_hi = sorted(self.scope, key=hi.get)
+            for L in set(lo.values()):
+                count = 0
+                for X in by_hi:
+                    if lo[X] < L:
+                        continue
+                    count += 1
+                    U = hi[X]
+                    if count > U - L + 1:
+                        return False
+                    if count == U - L + 1:
+                        for Y in self.scope:
+                            if (lo[Y] < L or hi[Y] > U) and (L <= lo[Y] <= U or L <= hi[Y] <= U):
+                                for val in domains[Y][:]:
+                                    if L <= rank[val] <= U:
+                                        csp.prune(Y, val, removals)
+                                if not domains[Y]:
+                                    return False
+                                changed = True
+                        if changed:
+                            break
+                if changed:
+                    break
+        return True
+
+
+def strongly_connected_components(adj):
+    """Tarjan's algorithm without recursion. adj[u] lists the successors of
+    vertex u; return the component number of each vertex."""
+    n = len(adj)
+    index, low, component = [None] * n, [0] * n, [None] * n
+    stack, on_stack = [], [False] * n
+    counter = components = 0
+    for root in range(n):
+        if index[root] is not None:
+            continue
+        work = [(root, 0)]
+        while work:
+            u, i = work[-1]
+            if i == 0:
+                index[u] = low[u] = counter
+                counter += 1
+                stack.append(u)
+                on_stack[u] = True
+            if i < len(adj[u]):
+                work[-1] = (u, i + 1)
+                w = adj[u][i]
+                if index[w] is None:
+                    work.append((w, 0))
+                elif on_stack[w]:
+                    low[u] = min(low[u], index[w])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[u])
+                if low[u] == index[u]:
+                    while True:
+                        w = stack.pop()
+                        on_stack[w] = False
+                        component[w] = components
+                        if w == u:
+                            break
+                    components += 1
+    return component
+
+
+def propagate_constraints(csp, variables=None, removals=None, bounds=False, index=None):
+    """Propagate the n-ary constraints of csp to their common fixpoint,
+    starting from those on the given variables (all, if None): each time a
+    constraint shrinks a domain, the other constraints on that variable are
+    queued again. With bounds, AllDifferent enforces only bounds
+    consistency. index is the {var: constraints} to use, by default
+    csp.var_constraints (all of them). Return False if a domain is wiped out."""
+    csp.support_pruning()
+    if index is None:
+        index = csp.var_constraints
+    if variables is None:
+        queue = deque({id(c): c for cs in index.values() for c in cs}.values())
+    else:
+        queue = deque({id(c): c for X in variables for c in index.get(X, ())}.values())
+    pending = set(map(id, queue))
+    domains = csp.curr_domains
+    while queue:
+        c = queue.popleft()
+        pending.discard(id(c))
+        sizes = [len(domains[X]) for X in c.scope]
+        if bounds and hasattr(c, 'propagate_bounds'):
+            consistent = c.propagate_bounds(csp, removals)
+        else:
+            consistent = c.propagate(csp, removals)
+        if not consistent:
+            return False
+        for X, size in zip(c.scope, sizes):
+            if len(domains[X]) != size:
+                if not domains[X]:
+                    return False
+                for other in index[X]:
+                    if other is not c and id(other) not in pending:
+                        pending.add(id(other))
+                        queue.append(other)
+    return True
+
+
+def forward_check_constraints(csp, var, assignment, removals=None):
+    """forward_check every checked (not redundant) n-ary constraint on var."""
+    return all(c.forward_check(csp, var, assignment, removals)
+               for c in csp.var_checks.get(var, ()))
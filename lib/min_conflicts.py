@@ -0,0 +1,68 @@
+import random
+
+#--------------------------------------------------------------------------------------------#
+# Min-conflicts local search (incremental repair)
+def min_conflicts(csp, max_steps=100000, walk_prob=0.0, random_ties=True, sample=None,
+                  initial=None):
+    """ Solve a CSP by stochastic hill climbing on the number of conflicts, as
+    detailed in Fig. 6.8 of AIMA book.
+    Starts from a complete assignment (initial, completed greedily) and, for
+    at most max_steps steps, picks a random conflicted variable and gives it
+    the value with the fewest conflicts. Options:
+        walk_prob    Probability of a random-walk step: a random value instead
+                     of the min-conflicts one, to escape plateaus.
+        random_ties  Break ties between min-conflicts values at random, in
+                     the scan; if False, prefer the first value in the domain.
+        sample       If set, only look at this many values of the domain per
+                     step, drawn by csp.sample_values, instead of all of them
+                     (for big domains).
+    Conflict counts are kept incrementally by csp.support_conflict_counts,
+    so each step costs O(values looked at). Returns the solution or None.
+    E.g. min_conflicts(NQueensCSP(10**5), sample=30) takes a few seconds;
+    without sample it takes 30-40 seconds, because a variable with no
+    conflict-free value has its whole domain scanned. """
+    current = {}
+    csp.support_conflict_counts(current)
+    initial = initial or {}
+    for var in csp.variables:
+        if var in initial:
+            val = initial[var]
+        else:
+            val = min_conflicts_value(csp, var, current, random_ties, sample)
+        csp.assign(var, val, current)
+    for i in range(max_steps):
+        if not csp.conflicted:
+            return current
+        var = csp.conflicted.choice()
+        if walk_prob and random.random() < walk_prob:
+            val = random.choice(csp.domains[var])
+        else:
+            val = min_conflicts_value(csp, var, current, random_ties, sample)
+        csp.assign(var, val, current)
+    return None if csp.conflicted else current
+
+def min_conflicts_value(csp, var, current, random_ties=True, sample=None):
+    """ Return the value that will give var the least number of conflicts.
+    A value without conflicts is returned as soon as it is found. With
+    random_ties the domain is scanned from a random offset, and ties between
+    values with conflicts are broken by reservoir sampling, so no copy of
+    the domain is made. """
+    domain = values = csp.domains[var]
+    d = len(domain)
+    if sample is not None and sample < d:
+        values = csp.sample_values(var, sample)
+    elif random_ties and d:
+        start = random.randrange(d)
+        values = (domain[(start + k) % d] for k in range(d))
+    best, fewest, ties = None, None, 0
+    for val in values:
+        n = csp.nconflicts(var, val, current)
+        if n == 0:
+            return val
+        if fewest is None or n < fewest:
+            best, fewest, ties = val, n, 1
+        elif n == fewest and random_ties:
+            ties += 1
+            if random.random() * ties < 1:
+                best = val
+    return best
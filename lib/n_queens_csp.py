@@ -1,8 +1,10 @@
 from __future__ import print_function
 import time
 import copy
+import random
 from lib.backtracking import backtracking_search
 from lib.csp import CSP
+from lib.utils import IndexedSet
 
 def queen_constraint(A, a, B, b):
     """Constraint is satisfied (true) if A, B are really the same variable,
@@ -27,14 +29,77 @@ class NQueensCSP(CSP):
         """Initialize data structures for n Queens."""
         # Indices of variables in the problem.
         variables = list(range(n))
-        # Initial domains of the variables.
-        domains = {var:list(range(n)) for var in variables}
+        # Initial domains of the variables, all sharing one immutable range
+        # (n separate lists would take O(n^2) memory).
+        domains = {var:range(n) for var in variables}
         # What are the neighbors of a given var, can include itself.
-        neighbors = {var:list(range(n)) for var in variables}
+        # Again one shared list for all the variables.
+        neighbors = {var:variables for var in variables}
         
         CSP.__init__(self, variables, domains, neighbors, queen_constraint)
     
 
+    def compile_constraints(self, key=None):
+        """The queen relation between A and B only depends on B - A."""
+        return CSP.compile_constraints(self, key or (lambda A, B: B - A))
+
+    # Incremental conflict counts: a queen is attacked once per other queen
+    # on its row, up diagonal or down diagonal, so it is enough to count the
+    # queens on each line. Each line also keeps the xor of its queens, which
+    # is the queen itself when only one is left on it, and the empty rows are
+    # kept apart so that local search can sample them.
+
+    def support_conflict_counts(self, assignment):
+        n = len(self.variables)
+        self.counted = assignment
+        self.rows, self.ups, self.downs = [0] * n, [0] * (2 * n - 1), [0] * (2 * n - 1)
+        self.conflict_counts = self.rows, self.ups, self.downs
+        self.line_xor = [0] * n, [0] * (2 * n - 1), [0] * (2 * n - 1)
+        self.free_rows = IndexedSet(range(n))
+        self.conflicted = IndexedSet()
+        for var, val in assignment.items():
+            self.count_conflicts(var, val, +1)
+
+    def lines(self, var, val):
+        return val, var + val, var - val + len(self.variables) - 1
+
+    def counted_nconflicts(self, var, val):
+        r, u, d = self.lines(var, val)
+        c = self.rows[r] + self.ups[u] + self.downs[d]
+        if self.counted.get(var) == val:
+            c -= 3
+        return c
+
+    def count_conflicts(self, var, val, delta):
+        for counts, xors, line in zip(self.conflict_counts, self.line_xor, self.lines(var, val)):
+            if delta > 0 and counts[line] == 1:
+                self.conflicted.add(xors[line])
+            counts[line] += delta
+            xors[line] ^= var
+            if delta < 0 and counts[line] == 1:
+                other = xors[line]
+                if self.counted_nconflicts(other, self.counted[other]) == 0:
+                    self.conflicted.discard(other)
+        if delta > 0 and self.counted_nconflicts(var, val) > 0:
+            self.conflicted.add(var)
+        else:
+            self.conflicted.discard(var)
+        if self.rows[val] == 0:
+            self.free_rows.add(val)
+        else:
+            self.free_rows.discard(val)
+
+    def sample_values(self, var, k):
+        """Alternate empty rows, the only ones that can take var out of conflict,
+        and random rows, so that the search does not get stuck in
+        permutations where every conflict is diagonal."""
+        n = len(self.variables)
+        for i in range(k):
+            if i % 2 == 0 and self.free_rows:
+                yield self.free_rows.choice()
+            else:
+                yield int(random.random() * n)
+
     def is_consistent(self, var, val, assignment):
         """ Check if the attempted var = val assignment is consistent with current assignment """
         # Add var = val in the list of assignments as a first attempt.
@@ -0,0 +1,161 @@
+import multiprocessing
+import pickle
+import queue
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from lib.backtracking import (backtracking_solutions, iterative_backtracking_search,
+                              first_unassigned_variable, mrv,
+                              unordered_domain_values, lcv,
+                              no_inference, forward_checking, mac)
+
+#--------------------------------------------------------------------------------------------#
+# Parallel backtracking by work splitting
+#
+# The search tree is cut into subproblems, each given by a prefix of decisions
+# [(var, val), ...]. A worker process replays the prefix on a fresh copy of the csp
+# and searches below it for at most max_nodes assignments. If it runs out of budget
+# it sends back the part of its subtree that it did not explore, as new prefixes,
+# so big subtrees keep being split while small ones are finished in one go.
+
+def parallel_backtracking_search(csp, select_unassigned_variable = first_unassigned_variable,
+                                 order_domain_values = unordered_domain_values,
+                                 inference = no_inference, workers = None, max_nodes = 2000):
+    """ Backtracking search split over worker processes. Returns the first solution
+    found by any worker (not necessarily the one backtracking_search finds) or None.
+    Once a solution is found the queued subproblems are cancelled; running ones stop
+    at the end of their budget of max_nodes assignments. """
+    result, _ = parallel_search(csp, (select_unassigned_variable, order_domain_values, inference),
+                                False, None, workers, max_nodes)
+    return result
+
+def parallel_count_solutions(csp, select_unassigned_variable = first_unassigned_variable,
+                             order_domain_values = unordered_domain_values,
+                             inference = no_inference, limit = None, workers = None,
+                             max_nodes = 2000):
+    """ Count the solutions of the csp (up to limit) over worker processes,
+    adding up the counts of every subproblem. """
+    _, found = parallel_search(csp, (select_unassigned_variable, order_domain_values, inference),
+                               True, limit, workers, max_nodes)
+    return found if limit is None else min(found, limit)
+
+def parallel_search(csp, plugins, counting, limit, workers, max_nodes):
+    """ Farm the subproblems out to a ProcessPoolExecutor. Return (solution, count). """
+    found = 0
+    with ProcessPoolExecutor(workers, initializer=init_worker,
+                             initargs=(pickle.dumps(csp), plugins)) as pool:
+        pending = {pool.submit(solve_subproblem, [], counting, max_nodes)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                solution, count, frontier = future.result()
+                found += count
+                if (solution is not None and not counting) or (limit is not None and found >= limit):
+                    for other in pending:
+                        other.cancel()
+                    return solution, found
+                for prefix in frontier:
+                    pending.add(pool.submit(solve_subproblem, prefix, counting, max_nodes))
+    return None, found
+
+# The csp and plug-ins are sent once to every worker process.
+worker_csp = None
+worker_plugins = None
+
+def init_worker(csp_bytes, plugins):
+    global worker_csp, worker_plugins
+    worker_csp = csp_bytes
+    worker_plugins = plugins
+
+def solve_subproblem(prefix, counting, max_nodes):
+    """ Search the subtree below prefix for at most max_nodes assignments.
+    Return (a solution or None, number of solutions, unexplored prefixes). """
+    csp = pickle.loads(worker_csp)
+    select_unassigned_variable, order_domain_values, inference = worker_plugins
+    assignment = {}
+    for var, val in prefix:
+        if not csp.is_consistent(var, val, assignment):
+            return None, 0, []
+        csp.assign(var, val, assignment)
+        removals = csp.suppose(var, val)
+        if not inference(csp, var, assignment, removals):
+            return None, 0, []
+    solutions = backtracking_solutions(csp, select_unassigned_variable, order_domain_values,
+                                       inference, copy=False, assignment=assignment,
+                                       max_nodes=max_nodes)
+    count = 0
+    while True:
+        try:
+            solution = next(solutions)
+        except StopIteration as stop:
+            frontier = stop.value or []
+            return None, count, [prefix + sub for sub in frontier]
+        count += 1
+        if not counting:
+            return dict(solution), count, []
+
+#--------------------------------------------------------------------------------------------#
+# Parallel portfolio
+#
+# Which heuristics win depends on the instance, so race several configurations
+# (select_unassigned_variable, order_domain_values, inference), each possibly with
+# several random seeds for the random tie breaking, and keep the first answer.
+
+DEFAULT_PORTFOLIO = [(mrv, unordered_domain_values, mac),
+                     (mrv, lcv, forward_checking),
+                     (mrv, unordered_domain_values, forward_checking),
+                     (first_unassigned_variable, unordered_domain_values, mac)]
+
+def portfolio_search(csp, configurations = DEFAULT_PORTFOLIO, seeds = (None,), timeout = None):
+    """ Run iterative_backtracking_search on the csp once per configuration and seed,
+    each in its own process, and return (result, winner) for the first run to finish;
+    the other runs are terminated. result is the solution, or None if the csp has no
+    solution; winner is a dict with the names of the plug-ins, the seed and the time
+    the run took, so that the defaults can be tuned per workload. A run that raises
+    reports its error instead; if every run fails, a RuntimeError with the last error
+    is raised. If no run finishes within timeout seconds, return (None, None). """
+    csp_bytes = pickle.dumps(csp)
+    results = multiprocessing.Queue()
+    runs = [(config, seed) for config in configurations for seed in seeds]
+    processes = [multiprocessing.Process(target=run_configuration,
+                                         args=(csp_bytes, i, config, seed, results), daemon=True)
+                 for i, (config, seed) in enumerate(runs)]
+    for p in processes:
+        p.start()
+    deadline = None if timeout is None else time.time() + timeout
+    try:
+        for _ in runs:
+            left = None if deadline is None else max(0, deadline - time.time())
+            i, result, elapsed, error = results.get(timeout=left)
+            if error is None:
+                break
+        else:
+            raise RuntimeError('every portfolio run failed, the last one with: ' + error)
+    except queue.Empty:
+        return None, None
+    finally:
+        for p in processes:
+            p.terminate()
+        for p in processes:
+            p.join()
+    (select_unassigned_variable, order_domain_values, inference), seed = runs[i]
+    winner = {'select_unassigned_variable': select_unassigned_variable.__name__,
+              'order_domain_values': order_domain_values.__name__,
+              'inference': inference.__name__,
+              'seed': seed,
+              'time': elapsed}
+    return result, winner
+
+def run_configuration(csp_bytes, i, config, seed, results):
+    """ Worker of portfolio_search: solve the csp with one configuration, and put
+    (i, result, time, None) on results, or (i, None, time, error) if the run raised. """
+    start_time = time.time()
+    try:
+        random.seed(seed)
+        csp = pickle.loads(csp_bytes)
+        result = iterative_backtracking_search(csp, *config)
+    except Exception as e:
+        results.put((i, None, time.time() - start_time, '{}: {}'.format(type(e).__name__, e)))
+    else:
+        results.put((i, result, time.time() - start_time, None))
@@ -1,4 +1,5 @@
 from lib.csp import CSP
+from lib.global_constraints import AllDifferent
 
 from functools import reduce
 import itertools
@@ -50,6 +51,7 @@ _NEIGHBORS = {v: set() for v in flatten(_ROWS)}
 for unit in map(set, _BOXES + _ROWS + _COLS):
     for v in unit:
         _NEIGHBORS[v].update(unit - {v})
+_NO_NEIGHBORS = {v: () for v in _NEIGHBORS}
 
 # ______________________________________________________________________________
 # Sudoku
@@ -87,6 +89,21 @@ class Sudoku(CSP):
     >>> h = Sudoku(harder1)
     >>> backtracking_search(h, select_unassigned_variable=mrv, inference=forward_checking) is not None
     True
+
+    The 27 units are declared as AllDifferent constraints. By default they
+    are redundant: the 1620 binary arcs of neighbors stay, so AC3, fc, mac,
+    min_conflicts and the rest work as on any binary csp, and the units only
+    serve the n-ary propagators (e.g. the gac inference). That does not save
+    memory: neighbors is one dict shared by every instance, and the units add
+    27 small objects to each. With binary=False the units replace the arcs
+    (neighbors are empty), so nconflicts (hence min_conflicts, whose
+    incremental counts recheck the units), forward_checking and mac check
+    and propagate them, mac by matching-based GAC; the binary-only
+    algorithms (AC3 alone, compiled tables, dom_wdeg's arc weights) then see
+    no arcs.
+    >>> u = Sudoku(harder1, binary=False)
+    >>> backtracking_search(u, select_unassigned_variable=mrv, inference=mac) is not None
+    True
     """  # noqa
 
     R3 = _R3
@@ -95,12 +112,14 @@ class Sudoku(CSP):
     boxes = _BOXES
     rows = _ROWS
     cols = _COLS
+    units = _BOXES + _ROWS + _COLS
     neighbors = _NEIGHBORS
 
-    def __init__(self, grid):
+    def __init__(self, grid, binary=True):
         """Build a Sudoku problem from a string representing the grid:
         the digits 1-9 denote a filled cell, '.' or '0' an empty one;
-        other characters are ignored."""
+        other characters are ignored. binary=False declares the units
+        instead of the binary arcs, see above."""
         squares = iter(re.findall(r'\d|\.', grid))
         domains = {var: [ch] if ch in '123456789' else '123456789'
                    for var, ch in zip(flatten(self.rows), squares)}
@@ -112,7 +131,15 @@ class Sudoku(CSP):
         # {A:[(B, b1), (B, b2), (C, c3)], B: [(C, c1)], ...}
         self.pruned = {var:[] for var in domains.keys()}
 
-        CSP.__init__(self, None, domains, self.neighbors, different_values_constraint)
+        CSP.__init__(self, None, domains, _NEIGHBORS if binary else _NO_NEIGHBORS,
+                     different_values_constraint)
+        # The 27 units: implied by the arcs if binary, else the constraints.
+        for unit in self.units:
+            self.add_constraint(AllDifferent(unit), redundant=binary)
+
+    def compile_constraints(self, key=None):
+        """All Sudoku arcs share the same relation (different values)."""
+        return CSP.compile_constraints(self, key or (lambda A, B: None))
 
     def display(self, assignment):
         n = 9
@@ -133,3 +160,62 @@ class Sudoku(CSP):
         a.axes.get_xaxis().set_ticklabels([])
         a.axes.get_yaxis().set_ticklabels([])
         plt.show()
+
+# ______________________________________________________________________________
+# Batched propagation
+#
+# Arc consistency on Sudoku removes a digit from a cell exactly when a peer
+# of the cell is down to that digit, so B puzzles can be propagated at once
+# on a (B x 81 x 9) boolean tensor D, D[b, var, k] meaning that digit k+1 is
+# still possible for var (numbered as in Sudoku) in puzzle b: one round is
+# a product of the 81 x 81 peer matrix with the singleton cells.
+
+_POSITIONS = np.argsort(flatten(_ROWS))  # Position in the grid string of each var
+_PEERS = np.zeros((81, 81), dtype=np.float32)
+for v, peers in _NEIGHBORS.items():
+    _PEERS[v, list(peers)] = 1
+
+def grids_to_tensor(grids):
+    """Return the (B x 81 x 9) domain tensor of a list of grid strings,
+    read as Sudoku reads them."""
+    cells = []
+    for grid in grids:
+        squares = re.findall(r'\d|\.', grid)
+        if len(squares) != 81:
+            raise ValueError("Not a Sudoku grid", grid)
+        cells.append(''.join(squares).replace('.', '0'))
+    digits = np.frombuffer(''.join(cells).encode(), dtype=np.uint8).reshape(-1, 81) - ord('0')
+    digits = digits[:, _POSITIONS]
+    D = np.ones((len(grids), 81, 9), dtype=bool)
+    given = digits > 0
+    D[given] = np.arange(1, 10) == digits[given][:, None]
+    return D
+
+def tensor_to_grids(D):
+    """Return the grid strings of a domain tensor, '.' where a cell has
+    more (or less) than one digit left."""
+    digits = np.where(D.sum(axis=2) == 1, D.argmax(axis=2) + ord('1'), ord('.'))
+    return [bytes(row.astype(np.uint8)).decode() for row in digits[:, np.argsort(_POSITIONS)]]
+
+def batch_AC3(grids):
+    """Run arc consistency on every grid at once, to the fixpoint of each.
+    Return (D, status, rounds): the domain tensor, an array with 'solved',
+    'unsolved' or 'failed' for each puzzle (as in PropagationResult), and
+    the number of rounds. A round only touches the puzzles that changed in
+    the previous one and have no empty cell."""
+    D = grids_to_tensor(grids)
+    active = np.arange(len(D))
+    rounds = 0
+    while len(active):
+        rounds += 1
+        A = D[active]
+        singles = A & (A.sum(axis=2, keepdims=True) == 1)
+        taken = np.matmul(_PEERS, singles.astype(np.float32)) > 0
+        new = A & ~taken
+        D[active] = new
+        changed = (new != A).any(axis=(1, 2))
+        active = active[changed & new.any(axis=2).all(axis=1)]
+    sizes = D.sum(axis=2)
+    status = np.where((sizes == 0).any(axis=1), 'failed',
+                      np.where((sizes == 1).all(axis=1), 'solved', 'unsolved'))
+    return D, status, rounds
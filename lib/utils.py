@@ -726,6 +726,46 @@ class hashabledict(dict):
         return 1
 
 
+class IndexedSet:
+    """A set that can also return a random element in O(1).
+    >>> s = IndexedSet([1, 2, 3]); s.discard(2); sorted(s), s.choice() in s
+    ([1, 3], True)
+    """
+
+    def __init__(self, iterable=()):
+        self.items = []
+        self.position = {}
+        for item in iterable:
+            self.add(item)
+
+    def add(self, item):
+        if item not in self.position:
+            self.position[item] = len(self.items)
+            self.items.append(item)
+
+    def discard(self, item):
+        """Remove item if present, by moving the last element into its slot."""
+        i = self.position.pop(item, None)
+        if i is not None:
+            last = self.items.pop()
+            if i < len(self.items):
+                self.items[i] = last
+                self.position[last] = i
+
+    def choice(self):
+        """Return a random element."""
+        return self.items[int(random.random() * len(self.items))]
+
+    def __contains__(self, item):
+        return item in self.position
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+
 # ______________________________________________________________________________
 # Queues: Stack, FIFOQueue, PriorityQueue
 # Stack and FIFOQueue are implemented as list and collection.deque
@@ -37,7 +37,7 @@ class InstruCSP(NQueensCSP):
         return super().is_consistent(var, val, assignment)
 
     def track_pruned_domain_for_display(self):
-        pruned_domains = copy.deepcopy(self.domains)
+        pruned_domains = {var: list(values) for var, values in self.domains.items()}
         for var, values in self.curr_domains.items():
             for val in values:
                 pruned_domains[var].remove(val)
@@ -46,7 +46,7 @@ class InstruCSP(NQueensCSP):
 
     def unassign(self, var, assignment):
         super().unassign(var, assignment)
-        pruned_domains = copy.deepcopy(self.domains)
+        pruned_domains = {var: list(values) for var, values in self.domains.items()}
         for var, values in self.curr_domains.items():
             for val in values:
                 pruned_domains[var].remove(val)